@@ -0,0 +1,12 @@
+"""
+Benchmarks of the pvpi pipeline, runnable off the Pi, without the real devices.
+
+- bench.house: a synthetic household (PV, consumption, heat pump), the source of all generated values
+- bench.datagrams: SMA HomeManager multicast datagrams, in the layout of HomeManager20.OBIS_OBJECTS
+- bench.fake_tripower: a local fake of the Tripower getDashValues.json endpoint
+- bench.replay: generated or recorded MQTT traffic, fed into the on_message() of mqtt-logger.py at N x real time
+- bench.run: runs the benchmarks and writes the results as json
+
+Run from the repository directory:
+    python -m bench.run --out bench-results.json
+"""
@@ -0,0 +1,110 @@
+"""
+Synthetic SMA HomeManager 2.0 multicast datagrams, in the layout of HomeManager20.OBIS_OBJECTS.
+
+To send them to the multicast group (e.g. to run pvpi-homemanager.py on a dev box):
+    python -m bench.datagrams --rate 1 --count 600
+"""
+
+import sys
+import time
+import socket
+import struct
+import argparse
+import importlib
+
+from bench.house import House
+
+hm = importlib.import_module("pvpi-homemanager")
+
+# Header words, as HomeManager20._decode_data() reads them
+_HEADER = ["current_transformer_ratio", "serial"]
+
+
+def _values(state):
+    """
+    measurement -> raw (unscaled) value, for all OBIS_OBJECTS, from a House state.
+    """
+    demands = {"positive_active":state["ppurchase"], "negative_active":state["psupply"],
+               "positive_reactive":0.1 * state["ppurchase"], "negative_reactive":0.1 * state["psupply"],
+               "positive_apparent":1.02 * state["ppurchase"], "negative_apparent":1.02 * state["psupply"]}
+    energies = {"positive_active":state["epurchase"], "negative_active":state["esupply"],
+                "positive_reactive":0.1 * state["epurchase"], "negative_reactive":0.1 * state["esupply"],
+                "positive_apparent":1.02 * state["epurchase"], "negative_apparent":1.02 * state["esupply"]}
+    values = {}
+    for (kind, power) in demands.items():
+        values[kind + "_demand"] = power
+        values[kind + "_energy"] = energies[kind]
+        for phase in ("L1", "L2", "L3"):
+            values[f"{kind}_demand_{phase}"] = power / 3.0
+            values[f"{kind}_energy_{phase}"] = energies[kind] / 3.0
+    for (i, phase) in enumerate(("L1", "L2", "L3")):
+        values["voltage_" + phase] = state[f"v{i + 1}"]
+        values["current_" + phase] = (state["ppurchase"] + state["psupply"]) / 3.0 / state[f"v{i + 1}"]
+        values["power_factor_" + phase] = 0.98
+    values["power_factor"] = 0.98
+    values["frequency"] = 50.0
+    return values
+
+
+class DatagramGenerator:
+
+    def __init__(self, seed=0, serial=1901234567):
+        self.house = House(seed)
+        self.serial = serial
+        self.ticker = 0
+        objects = hm.HomeManager20.OBIS_OBJECTS
+        self.header = {objects[obis]["measurement"]:obis for obis in objects if objects[obis]["measurement"] in _HEADER}
+        self.body = [(obis, struct.Struct(obj["format"]), obj["scale"], obj["measurement"])
+                     for (obis, obj) in objects.items()
+                     if obj["measurement"] not in _HEADER and obj["measurement"] != "fw_version"]
+        self.fw_obis = [obis for (obis, obj) in objects.items() if obj["measurement"] == "fw_version"][0]
+
+    def make(self, t=None):
+        """
+        Returns one datagram (bytes) for the time t (default now).
+        """
+        if t is None:
+            t = time.time()
+        self.ticker = (self.ticker + 1000) & 0xffffffff
+        values = _values(self.house.at(t))
+        parts = [b"SMA\x00",
+                 struct.pack(">II", self.header["current_transformer_ratio"], 1),
+                 struct.pack(">IHHII", self.header["serial"], 0x6069, 0x0174, self.serial, self.ticker)]
+        for (obis, st, scale, measurement) in self.body:
+            parts.append(struct.pack(">I", obis) + st.pack(int(round(values[measurement] * scale))))
+        parts.append(struct.pack(">IBBBc", self.fw_obis, 2, 3, 12, b"R"))
+        parts.append(b"\x00\x00\x00\x00")
+        return b"".join(parts)
+
+    def make_many(self, n, start=0.0, step=1.0):
+        return [self.make(start + i * step) for i in range(n)]
+
+
+def send(rate=1.0, count=600, group=hm.MCAST_GRP, port=hm.MCAST_PORT, seed=0):
+    """
+    Sends count datagrams at rate per second to the multicast group.
+    """
+    generator = DatagramGenerator(seed)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    next_time = time.time()
+    for i in range(count):
+        sock.sendto(generator.make(), (group, port))
+        next_time += 1.0 / rate
+        time.sleep(max(next_time - time.time(), 0))
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends synthetic SMA HomeManager datagrams")
+    parser.add_argument("--rate", type=float, default=1.0, help="Datagrams per second")
+    parser.add_argument("--count", type=int, default=600)
+    parser.add_argument("--group", default=hm.MCAST_GRP)
+    parser.add_argument("--port", type=int, default=hm.MCAST_PORT)
+    args = parser.parse_args()
+    send(args.rate, args.count, args.group, args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Local fake of the Tripower getDashValues.json endpoint (plain http, keep-alive), with values from bench.house.
+
+As a script:
+    python -m bench.fake_tripower --port 8080
+and point TripowerClient(url="http://127.0.0.1:8080/dyn/getDashValues.json") at it.
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from bench.house import House
+
+
+def dash_values(state):
+    """The json document of the endpoint, for a House state"""
+    def val(value):
+        return {"9":[{"val":value}]}
+    return {"result":{"01B8-xxxxx788":{
+        "6100_40463600":val(int(round(state["psupply"]))),
+        "6100_40463700":val(int(round(state["ppurchase"]))),
+        "6100_0046C200":val(int(round(state["pgenerate"]))),
+        "6400_00462400":val(int(round(1000 * state["esupply"]))),
+        "6400_00462500":val(int(round(1000 * state["epurchase"]))),
+        }}}
+
+
+class FakeTripower:
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0, seed=0):
+        """
+        port 0 picks a free port, see self.url. delay (seconds) is added to each answer.
+        """
+        self.house = House(seed)
+        self.delay = delay
+        self.n_requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.url = f"http://{host}:{self.server.server_address[1]}/dyn/getDashValues.json"
+        self.thread = None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if not self.path.startswith("/dyn/getDashValues.json"):
+                    self.send_error(404)
+                    return
+                if fake.delay > 0:
+                    time.sleep(fake.delay)
+                with fake.lock:
+                    fake.n_requests += 1
+                    body = json.dumps(dash_values(fake.house.at(time.time()))).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Tripower getDashValues.json endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds added to each answer")
+    args = parser.parse_args()
+    fake = FakeTripower(args.host, args.port, args.delay)
+    print(f"Fake Tripower on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        print("Bye!")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""
+Synthetic household: PV generation, household consumption and heat pump, as a function of time.
+"""
+
+import math
+import random
+
+
+class House:
+
+    def __init__(self, seed=0, peak_pv=8000.0, base_load=350.0, heatpump_power=1500.0):
+        self.rng = random.Random(seed)
+        self.peak_pv = peak_pv
+        self.base_load = base_load
+        self.heatpump_power = heatpump_power
+        self.t = None
+        self.esupply = 1000.0 # kWh
+        self.epurchase = 3000.0
+        self.clouds = 1.0
+
+    def at(self, t):
+        """
+        Returns a dict of values at time t (seconds since epoch, UTC), t must not decrease between calls.
+        Powers in W, energies in kWh.
+        """
+        hour = (t % 86400) / 3600.0
+        self.clouds = min(1.0, max(0.2, self.clouds + self.rng.gauss(0.0, 0.02)))
+        pgenerate = max(0.0, self.peak_pv * math.sin(math.pi * (hour - 6.0) / 12.0)) * self.clouds
+        if hour < 6.0 or hour > 18.0:
+            pgenerate = 0.0
+        heatpump = self.heatpump_power if (int(t) // 1800) % 3 == 0 else 0.0 # 30 minutes on, 60 off
+        pconsume = self.base_load + abs(self.rng.gauss(0.0, 150.0)) + heatpump
+        net = pgenerate - pconsume
+        psupply = max(net, 0.0)
+        ppurchase = max(-net, 0.0)
+
+        if self.t is not None:
+            hours = (t - self.t) / 3600.0
+            self.esupply += psupply * hours / 1000.0
+            self.epurchase += ppurchase * hours / 1000.0
+        self.t = t
+
+        return {"pgenerate":pgenerate,
+                "pconsume":pconsume,
+                "heatpump":heatpump,
+                "psupply":psupply,
+                "ppurchase":ppurchase,
+                "esupply":self.esupply,
+                "epurchase":self.epurchase,
+                "v1":230.0 + self.rng.gauss(0.0, 1.5),
+                "v2":230.0 + self.rng.gauss(0.0, 1.5),
+                "v3":230.0 + self.rng.gauss(0.0, 1.5),
+                }
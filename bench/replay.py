@@ -0,0 +1,175 @@
+"""
+MQTT traffic for mqtt-logger.py: generated (from bench.house), or recorded from a broker,
+and fed into its on_message() at N x real time.
+
+Traffic is a list of (t, topic, payload), t in seconds since epoch, payload bytes.
+Files are json lines {"t":..., "topic":..., "payload":...} (payload as latin-1 text).
+
+To record 10 minutes of real traffic on the Pi:
+    python -m bench.replay record traffic.jsonl --seconds 600
+"""
+
+import sys
+import json
+import math
+import time
+import argparse
+import importlib
+from datetime import datetime, timezone
+
+from bench.house import House
+
+
+class Message:
+    """The attributes of paho's MQTTMessage that on_message() uses"""
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def yesterday_start():
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today.timestamp() - 86400
+
+
+def generate(hours=24.0, start=None, seed=0, hm_interval=10.0, tp_interval=3.0, open3e_interval=15.0):
+    """
+    Returns the traffic of the HomeManager and Tripower json snapshots and of open3e (one message per topic,
+    the trigger topic last) as published during hours from start (default: yesterday 00:00 UTC).
+    """
+    ml = importlib.import_module("mqtt-logger")
+    if start is None:
+        start = yesterday_start()
+    end = start + 3600.0 * hours
+    house = House(seed)
+    open3e_topics = [topic for topic in ml.log_topics if topic.startswith("VitocalOpen3E/")]
+    open3e_topics.remove(ml.log_trigger_topic)
+    open3e_topics.append(ml.log_trigger_topic)
+
+    events = []
+    for (interval, kind) in ((hm_interval, "hm"), (tp_interval, "tp"), (open3e_interval, "open3e")):
+        t = start
+        while t < end:
+            events.append((t, kind))
+            t += interval
+    events.sort()
+
+    traffic = []
+    for (t, kind) in events:
+        state = house.at(t)
+        if kind == "hm":
+            snapshot = {key:round(state[key], 1) for key in ("psupply", "ppurchase", "v1", "v2", "v3")}
+            snapshot.update({"esupply":round(state["esupply"], 4), "epurchase":round(state["epurchase"], 4), "time":t})
+            traffic.append((t, "SMAHomeManager/snapshot", json.dumps(snapshot).encode()))
+        elif kind == "tp":
+            snapshot = {key:int(round(state[key])) for key in ("psupply", "ppurchase", "pgenerate", "pconsume")}
+            snapshot.update({"esupply":round(state["esupply"], 3), "epurchase":round(state["epurchase"], 3), "time":t})
+            traffic.append((t, "SMATripower/snapshot", json.dumps(snapshot).encode()))
+        else:
+            for (i, topic) in enumerate(open3e_topics):
+                # Slow daily drifts, at the 0.1 resolution of the sensors, as in the real data
+                value = state["heatpump"] / 1000.0 if topic == ml.log_trigger_topic else \
+                    round(20.0 + i + 3.0 * math.sin(2.0 * math.pi * t / 86400.0 + i), 1)
+                traffic.append((t + 0.001 * i, topic, f"{value:.2f}".encode()))
+    return traffic
+
+
+def save(path, traffic):
+    with open(path, "w") as f:
+        for (t, topic, payload) in traffic:
+            f.write(json.dumps({"t":t, "topic":topic, "payload":payload.decode("latin-1")}) + "\n")
+
+def load(path):
+    traffic = []
+    with open(path) as f:
+        for line in f:
+            d = json.loads(line)
+            traffic.append((d["t"], d["topic"], d["payload"].encode("latin-1")))
+    return traffic
+
+
+def record(path, seconds, broker="heizung.local", port=1883):
+    """
+    Records all messages of the broker for some seconds.
+    """
+    import paho.mqtt.client as mqtt
+    traffic = []
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe("#")
+    def on_message(client, userdata, message):
+        traffic.append((time.time(), message.topic, message.payload))
+    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+    mqttc.connect(broker, port)
+    mqttc.loop_start()
+    time.sleep(seconds)
+    mqttc.disconnect()
+    mqttc.loop_stop()
+    save(path, traffic)
+    return len(traffic)
+
+
+class Replayer:
+    """
+    Feeds traffic into the on_message() of the logger module ml, speed times faster than real time
+    (speed None: as fast as possible).
+    While replaying, ml.now() returns the time of the traffic, so that the rows get the times of the traffic.
+    """
+
+    def __init__(self, ml, userdata, speed=None):
+        self.ml = ml
+        self.userdata = userdata
+        self.speed = speed
+        self.clock = None
+        self.receive_time = None # perf_counter() when the current message was received
+        self.n = 0
+
+    def now(self):
+        return datetime.fromtimestamp(self.clock, timezone.utc)
+
+    def run(self, traffic, on_message=None):
+        if on_message is None:
+            on_message = self.ml.on_message
+        original_now = self.ml.now
+        self.ml.now = self.now
+        try:
+            real_start = time.perf_counter()
+            first = traffic[0][0] if traffic else 0.0
+            for (t, topic, payload) in traffic:
+                if self.speed is not None:
+                    wait = (t - first) / self.speed - (time.perf_counter() - real_start)
+                    if wait > 0:
+                        time.sleep(wait)
+                self.clock = t
+                self.receive_time = time.perf_counter()
+                on_message(None, self.userdata, Message(topic, payload))
+                self.n += 1
+        finally:
+            self.ml.now = original_now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates or records MQTT traffic for the benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="Record the traffic of the broker")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--seconds", type=float, default=600)
+    record_parser.add_argument("--broker", default="heizung.local")
+    generate_parser = subparsers.add_parser("generate", help="Write generated traffic to a file")
+    generate_parser.add_argument("path")
+    generate_parser.add_argument("--hours", type=float, default=24.0)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        n = record(args.path, args.seconds, args.broker)
+    else:
+        traffic = generate(args.hours)
+        save(args.path, traffic)
+        n = len(traffic)
+    print(f"Wrote {n} messages to {args.path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
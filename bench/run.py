@@ -0,0 +1,354 @@
+"""
+Runs the benchmarks, each in its own process (so that the peak RSS is its own), and writes the results as json.
+
+    python -m bench.run --out bench-results.json
+    python -m bench.run --only decode_data pipeline --traffic traffic.jsonl --speed 100
+
+Latencies are in ms, CPU times in microseconds per message / row (process or thread CPU time, not wall time).
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import importlib
+import importlib.util
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+
+
+def percentiles(values):
+    """dict with p50 and p99 (and max) in ms of a list of seconds"""
+    if len(values) == 0:
+        return {"p50_ms":None, "p99_ms":None, "max_ms":None}
+    values = sorted(values)
+    n = len(values)
+    return {"p50_ms":round(1000.0 * values[n // 2], 4),
+            "p99_ms":round(1000.0 * values[min(int(0.99 * n), n - 1)], 4),
+            "max_ms":round(1000.0 * values[-1], 4)}
+
+
+def make_db(ml, workdir, batch_size=20):
+    """A LogDB configured as in production (see make_db() in mqtt-logger.py), in workdir."""
+    ring = None
+    try:
+        import pvpi_ringbuffer
+        ring = pvpi_ringbuffer.RingBuffer.create("pvpi-bench", ml.log_topics_db, capacity=8192)
+    except ImportError:
+        pass
+    return ml.LogDB(name="pvpi", path=os.path.join(workdir, "pvpi.db"), export_workdir=workdir,
+                    cols=ml.log_topics_db, col_types=ml.log_topics_db_types, batch_size=batch_size, max_batch_age=300,
+                    export_compression="gzip", rollup_levels=ml.log_rollup_levels,
+                    counter_cols=ml.log_counter_topics_db, ring=ring, storage="dense", deadbands=ml.log_deadbands_db)
+
+
+def snapshot_dict(ml, date):
+    """A full latest-value dict, as on_message() builds it"""
+    d = {}
+    for (i, topic) in enumerate(ml.log_topics):
+        ml.log_plan.update(d, topic, f"{i}.5".encode(), date)
+    return d
+
+
+# The benchmarks. Each gets the parsed arguments and a temporary directory, and returns a dict.
+
+def bench_decode_data(args, workdir):
+    """HomeManager20._decode_data() on synthetic datagrams"""
+    from bench import datagrams
+    datagram_list = datagrams.DatagramGenerator().make_many(1000)
+    result = {}
+    for measurements in (None, "all"):
+        sma = datagrams.hm.HomeManager20(measurements=measurements, listen=False)
+        latencies = []
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for i in range(args.repeat):
+            for datagram in datagram_list:
+                start = time.perf_counter()
+                sma.datagram = datagram
+                sma._decode_data()
+                latencies.append(time.perf_counter() - start)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        n = len(latencies)
+        result["published" if measurements is None else "all"] = {
+            "messages":n, "msgs_per_s":round(n / wall), "cpu_us_per_msg":round(1e6 * cpu / n, 3),
+            "values_per_msg":len(sma.hmdata), **percentiles(latencies)}
+    return result
+
+
+def bench_log_mqtt_to_db(args, workdir):
+    """log_mqtt_to_db() with a full latest-value dict, one row per call, including the batched commits"""
+    ml = importlib.import_module("mqtt-logger")
+    db = make_db(ml, workdir)
+    start_date = datetime.now(timezone.utc)
+    d = snapshot_dict(ml, start_date)
+    latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(args.rows):
+        lognow = datetime.fromtimestamp(start_date.timestamp() + 0.001 * i, timezone.utc)
+        start = time.perf_counter()
+        ml.log_mqtt_to_db(d, db, lognow=lognow)
+        latencies.append(time.perf_counter() - start)
+    db.flush()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    db.close()
+    return {"rows":args.rows, "rows_per_s":round(args.rows / wall), "cpu_us_per_row":round(1e6 * cpu / args.rows, 3),
+            **percentiles(latencies)}
+
+
+def bench_logdb_log(args, workdir):
+    """LogDB.log() with a dict of column values, including the batched commits"""
+    ml = importlib.import_module("mqtt-logger")
+    db = make_db(ml, workdir)
+    row = {col:float(i) for (i, col) in enumerate(ml.log_topics_db)}
+    start_ms = ml.to_epoch_ms(datetime.now(timezone.utc))
+    latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(args.rows):
+        date = datetime.fromtimestamp((start_ms + i) / 1000.0, timezone.utc)
+        start = time.perf_counter()
+        db.log(row, date=date)
+        latencies.append(time.perf_counter() - start)
+    db.flush()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    db.close()
+    return {"rows":args.rows, "rows_per_s":round(args.rows / wall), "cpu_us_per_row":round(1e6 * cpu / args.rows, 3),
+            **percentiles(latencies)}
+
+
+def bench_export_last_day(args, workdir):
+    """LogDB.export_last_day() of a full day (one row every 15 s), gzip csv and columnar"""
+    ml = importlib.import_module("mqtt-logger")
+    db = make_db(ml, workdir, batch_size=1000)
+    db.export_columnar = importlib.util.find_spec("numpy") is not None
+    start = ml.day_start(ml.now()).timestamp() - 86400
+    row = [float(i) for i in range(len(ml.log_topics_db))]
+    n = 86400 // 15
+    for i in range(n):
+        db.log_row(row, date=datetime.fromtimestamp(start + 15 * i, timezone.utc))
+    db.flush()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    manifest = db.export_last_day()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    db.close()
+    return {"rows":manifest["rows"], "bytes":manifest["bytes"], "columnar":db.export_columnar,
+            "seconds":round(wall, 4), "rows_per_s":round(manifest["rows"] / wall),
+            "cpu_us_per_row":round(1e6 * cpu / manifest["rows"], 3),
+            "peak_rss_before_kb":rss_before}
+
+
+def bench_pipeline(args, workdir):
+    """
+    Traffic replayed into on_message(), through the LogWriter thread into the db:
+    messages/s, latency from receiving the trigger message to the commit of its row, CPU time per stage.
+    """
+    from bench import replay
+    ml = importlib.import_module("mqtt-logger")
+    if args.traffic is not None:
+        traffic = replay.load(args.traffic)
+    else:
+        traffic = replay.generate(args.hours)
+
+    db = make_db(ml, workdir, batch_size=args.batch_size)
+    writer = ml.LogWriter(db, maxsize=1000, overflow="block")
+    userdata = {"dict":{}, "writer":writer}
+    replayer = replay.Replayer(ml, userdata, speed=args.speed)
+
+    # Instrumentation, by wrapping the functions of each stage
+    received = {} # row time (ms) -> perf_counter() when its trigger message was received
+    latencies = []
+    cpu = {"on_message":0.0, "log_mqtt_to_db":0.0, "LogDB.flush":0.0}
+
+    original_put = writer.put
+    def put(lognow, snapshot):
+        received[ml.to_epoch_ms(lognow)] = replayer.receive_time
+        original_put(lognow, snapshot)
+    writer.put = put
+
+    original_flush = db.flush
+    def flush():
+        times = [row[0] for row in db.batch]
+        start = time.thread_time()
+        original_flush()
+        cpu["LogDB.flush"] += time.thread_time() - start
+        committed = time.perf_counter()
+        for time_ms in times:
+            if time_ms in received:
+                latencies.append(committed - received.pop(time_ms))
+    db.flush = flush
+
+    original_log_mqtt_to_db = ml.log_mqtt_to_db
+    def log_mqtt_to_db(newdict, db, lognow=None):
+        start = time.thread_time()
+        flush_before = cpu["LogDB.flush"]
+        original_log_mqtt_to_db(newdict, db, lognow=lognow)
+        # Without the flushes, which are counted on their own
+        cpu["log_mqtt_to_db"] += time.thread_time() - start - (cpu["LogDB.flush"] - flush_before)
+    ml.log_mqtt_to_db = log_mqtt_to_db
+
+    def on_message(client, userdata, message):
+        start = time.thread_time()
+        ml.on_message(client, userdata, message)
+        cpu["on_message"] += time.thread_time() - start
+
+    writer.start()
+    wall_start = time.perf_counter()
+    replayer.run(traffic, on_message=on_message)
+    replay_wall = time.perf_counter() - wall_start
+    writer.stop()
+    db.close()
+    wall = time.perf_counter() - wall_start
+
+    n_rows = len(latencies)
+    return {"messages":replayer.n, "rows":n_rows, "speed":args.speed, "batch_size":args.batch_size,
+            "msgs_per_s":round(replayer.n / replay_wall), "seconds":round(wall, 3),
+            "commit_latency":percentiles(latencies),
+            "cpu_us_per_msg":{"on_message":round(1e6 * cpu["on_message"] / max(replayer.n, 1), 3)},
+            "cpu_us_per_row":{"log_mqtt_to_db":round(1e6 * cpu["log_mqtt_to_db"] / max(n_rows, 1), 3),
+                              "LogDB.flush":round(1e6 * cpu["LogDB.flush"] / max(n_rows, 1), 3)},
+            "writer":writer.stats()}
+
+
+def bench_tripower(args, workdir):
+    """TripowerClient polling the local fake endpoint"""
+    from bench import fake_tripower
+    tp = importlib.import_module("pvpi-tripower")
+    fake = fake_tripower.FakeTripower().start()
+    client = tp.TripowerClient(url=fake.url)
+    latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(args.requests):
+        start = time.perf_counter()
+        client.read()
+        latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start # Includes the fake server, which runs in this process
+    metrics = client.metrics()
+    client.close()
+    fake.stop()
+    return {"requests":args.requests, "requests_per_s":round(args.requests / wall),
+            "cpu_us_per_request_incl_server":round(1e6 * cpu / args.requests, 1),
+            "handshake_reuse":metrics["handshake_reuse"], "errors":metrics["n_errors"], **percentiles(latencies)}
+
+
+def bench_align(args, workdir):
+    """
+    pvpi_align: a week of 1 Hz rows (HomeManager readings every second, Tripower every 3 s, open3e every 15 s,
+    each with its own reading times), aligned to a 1 s grid with linear interpolation, plus derive():
+    only the cols derive() needs, and all of them
+    """
+    import numpy as np
+    import pvpi_align
+    ml = importlib.import_module("mqtt-logger")
+    rng = np.random.default_rng(0)
+    n = int(args.days * 86400)
+    start = ml.day_start(ml.now()).timestamp() - n
+    row_times = start + np.arange(n, dtype=np.float64)
+    data = {"time":(1000 * row_times).astype(np.int64)}
+    for (source, interval) in (("SMAHomeManager", 1), ("SMATripower", 3), ("VitocalOpen3E", 15)):
+        # The reading each row holds: the last one, taken a bit before it arrived
+        reading = np.arange(n) // interval
+        data[source + "_time"] = start + interval * reading - rng.uniform(0.0, 0.5, reading[-1] + 1)[reading]
+    for col in ml.log_topics_db:
+        if col.endswith("_time"):
+            continue
+        phase = data[pvpi_align.source_of(col) + "_time"]
+        data[col] = 1000.0 * np.sin(2 * np.pi * phase / 86400.0) + rng.normal(0.0, 10.0, n)
+    grid = pvpi_align.make_grid(start, start + n, 1.0)
+    result = {"rows":n, "grid":len(grid)}
+    for (name, cols) in (("derive_cols", pvpi_align.derive_cols), ("all_cols", None)):
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        aligned = pvpi_align.align(data, grid, cols=cols, method="linear")
+        derived = pvpi_align.derive(aligned)
+        wall = time.perf_counter() - wall_start
+        result[name] = {"cols":len(aligned) - 1, "seconds":round(wall, 4), "cpu_s":round(time.process_time() - cpu_start, 4),
+                        "covered":round(float(np.mean(~np.isnan(derived["pconsume"]))), 4)}
+        del aligned, derived
+    return result
+
+
+benchmarks = {"decode_data":bench_decode_data,
+              "log_mqtt_to_db":bench_log_mqtt_to_db,
+              "logdb_log":bench_logdb_log,
+              "export_last_day":bench_export_last_day,
+              "pipeline":bench_pipeline,
+              "tripower":bench_tripower,
+              "align":bench_align,
+              }
+
+
+def _run_one(name, args):
+    """Runs in the child process"""
+    workdir = tempfile.mkdtemp(prefix=f"pvpi-bench-{name}-")
+    try:
+        result = benchmarks[name](args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the pvpi pipeline")
+    parser.add_argument("--out", default="bench-results.json", help="json file for the results")
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks.keys()), help="Run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=20, help="decode_data: passes over 1000 datagrams")
+    parser.add_argument("--rows", type=int, default=20000, help="log_mqtt_to_db, logdb_log: number of rows")
+    parser.add_argument("--requests", type=int, default=500, help="tripower: number of requests")
+    parser.add_argument("--traffic", help="pipeline: replay this recorded traffic file instead of generated traffic")
+    parser.add_argument("--hours", type=float, default=24.0, help="pipeline: hours of generated traffic")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="pipeline: replay at this multiple of real time (default: as fast as possible)")
+    parser.add_argument("--batch-size", type=int, default=20, help="pipeline: LogDB batch_size")
+    parser.add_argument("--days", type=float, default=7.0, help="align: days of 1 Hz rows")
+    args = parser.parse_args()
+
+    names = args.only or list(benchmarks.keys())
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        print(f"Running {name}...", flush=True)
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(_run_one, (name, args))
+        print(json.dumps(results[name]), flush=True)
+
+    output = {"meta":{"created":datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                      "host":socket.gethostname(),
+                      "machine":platform.machine(),
+                      "python":platform.python_version(),
+                      "git":git_revision(),
+                      "args":vars(args)},
+              "results":results}
+    with open(args.out, "w") as f:
+        json.dump(output, f, indent=1)
+    print(f"Wrote {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Checkplots of the logged data for the daily email: a "daily" figure of yesterday and a "weekly" one of the last 7 days
+(complete UTC days), each made of the panels below, attached as PNG files.
+
+    python pvpi-checkplots.py --to someone@example.org
+    python pvpi-checkplots.py --out checkplots.eml
+
+- The data comes already downsampled from the db, via pvpi_query: from the rollup tables where the step allows it,
+  which reach further back than the partitions (after an import of the daily exports, see rebuild-rollups).
+  The steps give at most about one point per pixel.
+- Each rendered panel gets cached as PNG in the cache directory, keyed by its cols and time range, with a json
+  next to it holding a fingerprint of the plotted data and the render time. A panel only gets rendered again
+  if its data changed (e.g., after an import or a late row), and the email is built from the cached files.
+- Panels are rendered one at a time, each into its own small matplotlib Figure (without pyplot, so nothing stays
+  around), and matplotlib only gets imported when something needs rendering. Before each rendering, the memory (RSS)
+  is compared with the budget: above it, the panel is not rendered, an older PNG of it is used if there is one.
+
+Needs matplotlib for the rendering.
+"""
+
+import os
+import io
+import gc
+import sys
+import json
+import time
+import hashlib
+import smtplib
+import argparse
+import resource
+from email.message import EmailMessage
+from datetime import datetime, timedelta, timezone
+
+import pvpi_query
+import pvpi_metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Panel name -> title, unit, and the plotted cols (db names) with their labels
+panels = {
+    "power":{"title":"Power", "unit":"W",
+             "cols":{"SMATripower_pgenerate":"PV", "SMAHomeManager_psupply":"Grid supply",
+                     "SMAHomeManager_ppurchase":"Grid purchase"}},
+    "heatpump":{"title":"Heat pump", "unit":"kW",
+                "cols":{"VitocalOpen3E_CurrentElectricalPowerConsumptionSystem":"Electrical",
+                        "VitocalOpen3E_ThermalPower":"Thermal"}},
+    "temperatures":{"title":"Temperatures", "unit":"°C",
+                    "cols":{"VitocalOpen3E_OutsideTemperatureSensor_Actual":"Outside",
+                            "VitocalOpen3E_FlowTemperatureSensor_Actual":"Flow",
+                            "VitocalOpen3E_ReturnTemperatureSensor_Actual":"Return",
+                            "VitocalOpen3E_DomesticHotWaterSensor_Actual":"Hot water"}},
+    "voltages":{"title":"Grid voltages", "unit":"V",
+                "cols":{"SMAHomeManager_v1":"L1", "SMAHomeManager_v2":"L2", "SMAHomeManager_v3":"L3"}},
+    }
+
+# Figure name -> number of days, step (seconds between points) and the unit of the time axis (seconds)
+figures = {"daily":{"days":1, "step":300, "axis":3600},
+           "weekly":{"days":7, "step":1800, "axis":86400},
+           }
+
+# Part of the cache keys: to be increased when the rendering changes, so that all panels get rendered again
+render_version = 1
+
+figure_size = (8.0, 2.5) # inches
+figure_dpi = 80 # 640 pixels wide
+
+
+class PanelCache:
+    """
+    The rendered panels in a directory: <key>.png and <key>.json, the files older than max_age_days get removed.
+    """
+
+    def __init__(self, path, max_age_days=30):
+        self.path = path
+        self.max_age_days = max_age_days
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, figure, panel, start_ms, end_ms):
+        spec = [render_version, figure, figures[figure], panel, panels[panel], start_ms, end_ms]
+        return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:20]
+
+    def png_path(self, key):
+        return os.path.join(self.path, key + ".png")
+
+    def meta(self, key):
+        """The json of the panel, or None if it is not in the cache"""
+        try:
+            with open(os.path.join(self.path, key + ".json")) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta if os.path.exists(self.png_path(key)) else None
+
+    def put(self, key, png, meta):
+        # The png first: a json always has its png
+        for (filename, mode, content) in ((key + ".png", "wb", png), (key + ".json", "w", json.dumps(meta, indent=1))):
+            path = os.path.join(self.path, filename)
+            with open(path + ".part", mode) as f:
+                f.write(content)
+            os.replace(path + ".part", path)
+
+    def read(self, key):
+        with open(self.png_path(key), "rb") as f:
+            return f.read()
+
+    def cleanup(self):
+        limit = time.time() - 86400 * self.max_age_days
+        n = 0
+        for filename in os.listdir(self.path):
+            path = os.path.join(self.path, filename)
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+                n += 1
+        if n > 0:
+            logger.info(f"Removed {n} old files from {self.path}")
+
+
+def fingerprint(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def rss_mb():
+    rss_kb = pvpi_metrics.process_stats()[0]["rss_kb"]
+    return None if rss_kb is None else rss_kb / 1024.0
+
+
+def render(figure, panel, data, start_ms, end_ms):
+    """Returns the PNG (bytes) of the panel"""
+    from matplotlib.figure import Figure # Optional, only needed here
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    spec = panels[panel]
+    axis_ms = 1000 * figures[figure]["axis"]
+    fig = Figure(figsize=figure_size, dpi=figure_dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    x = [(time_ms - start_ms) / axis_ms for time_ms in data["time"]]
+    for (col, label) in spec["cols"].items():
+        ax.plot(x, [float("nan") if value is None else value for value in data[col]], label=label, linewidth=0.8)
+    ax.set_xlim(0, (end_ms - start_ms) / axis_ms)
+    start = datetime.fromtimestamp(start_ms / 1000, timezone.utc)
+    ax.set_title("{} from {}".format(spec["title"], start.strftime("%Y-%m-%d")), fontsize="medium")
+    ax.set_xlabel("hours (UTC)" if figures[figure]["axis"] == 3600 else "days")
+    ax.set_ylabel(spec["unit"])
+    ax.grid(alpha=0.3)
+    ax.legend(loc="upper left", fontsize="small", ncol=len(spec["cols"]))
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    fig.clear()
+    return buffer.getvalue()
+
+
+def update(service, cache, end, memory_budget=None):
+    """
+    Renders the panels of all figures ending at end (a datetime, excluded) that are not in the cache yet,
+    or whose data changed. memory_budget is in MB.
+    Returns the report: a list of dicts, one per panel, with the cache key and the status
+    ("rendered", "cached", "no data" or "over budget"), and the render time.
+    """
+    report = []
+    for (figure, figure_spec) in figures.items():
+        start = end - timedelta(days=figure_spec["days"])
+        (start_ms, end_ms) = (pvpi_query.to_ms(start), pvpi_query.to_ms(end))
+        for panel in panels:
+            key = cache.key(figure, panel, start_ms, end_ms)
+            data = service.query(list(panels[panel]["cols"]), start, end, step=figure_spec["step"])
+            data_fingerprint = fingerprint(data)
+            meta = cache.meta(key)
+            entry = {"figure":figure, "panel":panel, "key":key, "points":len(data["time"]), "render_s":None}
+            if meta is not None and meta["fingerprint"] == data_fingerprint:
+                entry["status"] = "cached"
+                entry["render_s"] = meta["render_s"]
+            elif len(data["time"]) == 0:
+                entry["status"] = "no data"
+            else:
+                if memory_budget is not None and rss_mb() is not None and rss_mb() > memory_budget:
+                    gc.collect()
+                if memory_budget is not None and rss_mb() is not None and rss_mb() > memory_budget:
+                    entry["status"] = "over budget"
+                    logger.warning(f"Not rendering {figure} {panel}: {rss_mb():.0f} MB used, the budget is {memory_budget} MB")
+                else:
+                    starttime = time.perf_counter()
+                    png = render(figure, panel, data, start_ms, end_ms)
+                    entry["render_s"] = round(time.perf_counter() - starttime, 3)
+                    cache.put(key, png, {"figure":figure, "panel":panel, "start":start.isoformat(), "end":end.isoformat(),
+                                         "points":len(data["time"]), "fingerprint":data_fingerprint,
+                                         "render_s":entry["render_s"], "created":datetime.now(timezone.utc).isoformat()})
+                    entry["status"] = "rendered"
+                    logger.info(f"Rendered {figure} {panel} in {entry['render_s']:.2f} s")
+            report.append(entry)
+            data = None
+    return report
+
+
+def build_email(report, cache, subject, sender, recipient):
+    """The email with the cached PNG of each panel attached, and the report as text"""
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = recipient
+    lines = []
+    for entry in report:
+        render_s = "" if entry["render_s"] is None else f", rendered in {entry['render_s']:.2f} s"
+        lines.append(f"{entry['figure']:8} {entry['panel']:14} {entry['status']:12} {entry['points']} points{render_s}")
+    message.set_content("\n".join(lines) + "\n")
+    for entry in report:
+        if cache.meta(entry["key"]) is not None: # Also an older PNG if over budget
+            message.add_attachment(cache.read(entry["key"]), maintype="image", subtype="png",
+                                   filename="{}-{}.png".format(entry["figure"], entry["panel"]))
+    return message
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders the checkplots (cached) and sends them by email")
+    parser.add_argument("--db", default="/home/mtewes/data/pvpi.db", help="Path to the logger db")
+    parser.add_argument("--cache", default="/home/mtewes/data/checkplots", help="Directory of the rendered panels")
+    parser.add_argument("--date", help="Last day to plot (YYYY-MM-DD, UTC), default yesterday")
+    parser.add_argument("--memory-budget", type=float, default=150.0, help="Do not render above this RSS (MB)")
+    parser.add_argument("--to", help="Send the email to this address")
+    parser.add_argument("--sender", default="pvpi@localhost", help="From address of the email")
+    parser.add_argument("--smtp", default="localhost", help="SMTP server")
+    parser.add_argument("--out", help="Write the email to this file instead of sending it")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.date is None:
+        end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        end = datetime.strptime(args.date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+
+    service = pvpi_query.QueryService(args.db, pool_size=1, cache_size=8)
+    cache = PanelCache(args.cache)
+    report = update(service, cache, end, memory_budget=args.memory_budget)
+    service.close()
+    cache.cleanup()
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    logger.info(f"Peak memory {peak_mb:.0f} MB")
+
+    if args.to is not None or args.out is not None:
+        subject = "pvpi checkplots {}".format((end - timedelta(days=1)).strftime("%Y-%m-%d"))
+        message = build_email(report, cache, subject, args.sender, args.to or "")
+        if args.out is not None:
+            with open(args.out, "wb") as f:
+                f.write(message.as_bytes())
+        else:
+            with smtplib.SMTP(args.smtp) as smtp:
+                smtp.send_message(message)
+            logger.info(f"Sent the checkplots to {args.to}")
+    print(json.dumps({"panels":report, "peak_mb":round(peak_mb, 1)}, indent=1))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""
+Runs the HomeManager reader, the Tripower poller and the logger in one process, as asyncio tasks,
+instead of three separate scripts (see start.bash).
+
+- One MQTT connection: the readings of the HomeManager and the Tripower are still published as json snapshots
+  (for the SG-Ready control, the display, ...), but they are handed to the logger in-process,
+  the logger only subscribes to the other topics (open3e).
+- The logger writes a row every log_interval seconds (aligned to the wall clock), or in trigger mode whenever
+  the trigger topic of open3e arrives, as mqtt-logger.py.
+- Each task gets restarted on its own after a crash, with an increasing delay.
+
+The scripts are loaded as modules from their files (they have dashes in their names), so they keep working standalone.
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import asyncio
+import argparse
+import importlib.util
+from datetime import datetime, timezone
+
+import paho.mqtt.client as mqtt
+
+import pvpi_metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def load_script(name):
+    """
+    Imports the script <name>.py next to this file as a module.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Daemon:
+    """
+    State shared by the tasks: the MQTT client, and the latest-value dict and LogWriter of the logger.
+    Everything except the LogWriter thread and the MQTT network thread runs in the event loop,
+    so the latest-value dict is only touched from there.
+    """
+
+    def __init__(self, broker="heizung.local", port=1883, hm_interval=10.0, fanout=False, log_mode=None, log_interval=None):
+        self.ml = load_script("mqtt-logger")
+        self.hm = load_script("pvpi-homemanager")
+        self.tp = load_script("pvpi-tripower")
+
+        self.broker = broker
+        self.port = port
+        self.hm_interval = hm_interval
+        self.fanout = fanout
+        self.log_mode = log_mode if log_mode is not None else self.ml.log_mode
+        self.log_interval = log_interval if log_interval is not None else self.ml.log_interval
+        self.loop = None
+        self.mqttc = None
+        # As in mqtt-logger.py
+        self.userdata = {"dict":{}, "writer":None, "trigger":self.ml.log_trigger_topic if self.log_mode == "trigger" else None}
+        self.n_restarts = {}
+
+        # Topics that reach the logger in-process, it must not subscribe to them
+        self.local_prefixes = ("SMAHomeManager/", "SMATripower/")
+        self.subscribed_topics = [topic for topic in self.ml.log_topics if not topic.startswith(self.local_prefixes)]
+
+    # MQTT
+
+    def connect(self):
+        self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.mqttc.on_connect = self.on_connect
+        self.mqttc.on_message = self.on_message
+        self.mqttc.connect_async(self.broker, self.port)
+        self.mqttc.loop_start()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print(f"Failed to connect: {reason_code}. Will retry.")
+        else:
+            for topic in self.subscribed_topics:
+                client.subscribe(topic)
+
+    def on_message(self, client, userdata, message):
+        # Called in the MQTT network thread: pass the message on to the event loop
+        self.loop.call_soon_threadsafe(self.ml.handle_message, self.userdata, message.topic, message.payload)
+
+    def handoff(self, prefix, d, extra=None):
+        """
+        Hands a reading d (dict of decoded values) to the logger, and publishes it as a json snapshot.
+        """
+        self.ml.log_plan.update_values(self.userdata["dict"], prefix, d, self.ml.now())
+        snapshot = dict(d)
+        if extra is not None:
+            snapshot.update(extra)
+        # Not waiting for the publication, it happens in the network thread
+        self.mqttc.publish(prefix + "snapshot", json.dumps(snapshot, separators=(",", ":")), qos=0)
+        if self.fanout:
+            for (key, value) in snapshot.items():
+                if isinstance(value, dict):
+                    value = json.dumps(value, separators=(",", ":"))
+                self.mqttc.publish(prefix + key, value, qos=0)
+
+    # Tasks
+
+    async def homemanager(self):
+        sma = self.hm.HomeManager20()
+        aggregator = self.hm.WindowAggregator(self.hm.HomeManager20.AGGREGATED)
+        # Every datagram gets decoded into the aggregator as soon as it arrives
+        self.loop.add_reader(sma.sock, sma.read_window, aggregator)
+        try:
+            next_time = time.time()
+            next_metrics_time = next_time + 60
+            while True:
+                next_time += self.hm_interval
+                await asyncio.sleep(max(next_time - time.time(), 0))
+                sma.read_window(aggregator)
+                if aggregator.n > 0:
+                    d = aggregator.values()
+                    d["time"] = round(aggregator.last_time, 3)
+                    self.handoff("SMAHomeManager/", d, {"window":aggregator.summary()})
+                    aggregator.reset()
+                if time.time() > next_metrics_time:
+                    self.mqttc.publish("SMAHomeManager/metrics", json.dumps(sma.metrics()), qos=0)
+                    next_metrics_time += 60
+        finally:
+            self.loop.remove_reader(sma.sock)
+            sma.sock.close()
+
+    async def tripower(self):
+        client = self.tp.TripowerClient()
+        poll = self.tp.PollInterval()
+        try:
+            next_metrics_time = time.time() + 60
+            while True:
+                start = time.time()
+                # requests is blocking, so it runs in a worker thread. The backoff after errors happens here,
+                # so that this task can be cancelled meanwhile.
+                response = await self.loop.run_in_executor(None, client.try_fetch)
+                if response is None:
+                    await asyncio.sleep(client.backoff())
+                    continue
+                d = client.parse(response) # With the time when the response arrived
+                self.handoff("SMATripower/", d)
+                if time.time() >= next_metrics_time:
+                    self.mqttc.publish("SMATripower/metrics", json.dumps(client.metrics()), qos=0)
+                    next_metrics_time += 60
+                await asyncio.sleep(max(poll.next(d, start) - (time.time() - start), 0))
+        finally:
+            client.close()
+
+    async def logwriter(self):
+        ring = self.ml.make_ring()
+        db = self.ml.make_db(ring=ring)
+        balance = self.ml.make_balance()
+        balance.mqttc = self.mqttc
+        writer = self.ml.make_writer(db, balance=balance)
+        writer.start()
+        self.userdata["writer"] = writer
+        try:
+            while True:
+                await asyncio.sleep(10)
+                if not writer.thread.is_alive():
+                    raise RuntimeError("LogWriter thread died")
+        finally:
+            self.userdata["writer"] = None
+            if writer.thread.is_alive():
+                await self.loop.run_in_executor(None, writer.stop) # Flushes, can take a moment
+            balance.save()
+            db.close()
+
+    async def snapshots(self):
+        """
+        Timer mode: hands a snapshot to the LogWriter at each slot, see SnapshotScheduler in mqtt-logger.py.
+        """
+        scheduler = self.ml.SnapshotScheduler(self.userdata, self.log_interval)
+        slot = 0.0
+        while True:
+            # max(): the sleep may end a little before the slot
+            slot = scheduler.next_slot(max(time.time(), slot))
+            await asyncio.sleep(max(slot - time.time(), 0))
+            scheduler.tick(datetime.fromtimestamp(slot, timezone.utc))
+
+    def writer_stats(self):
+        writer = self.userdata["writer"]
+        if writer is None:
+            return None
+        return {"queue":writer.stats(), "flush":writer.db.flush_stats(), "energy":writer.balance.stats()}
+
+    async def supervise(self, name, task, min_delay=5.0, max_delay=300.0):
+        """
+        Runs the coroutine function task, restarting it whenever it fails.
+        The delay doubles with each failure, and gets reset once the task ran for 10 minutes.
+        """
+        delay = min_delay
+        self.n_restarts[name] = 0
+        while True:
+            start = time.time()
+            try:
+                await task()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Task {name} failed")
+            else:
+                logger.warning(f"Task {name} ended")
+            if time.time() - start > 600:
+                delay = min_delay
+            logger.info(f"Restarting task {name} in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, max_delay)
+            self.n_restarts[name] += 1
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, stop.set)
+
+        self.connect()
+        pvpi_metrics.start_publisher(self.mqttc, "daemon", gauges={"writer":self.writer_stats,
+                                                                   "stale":self.ml.log_plan.staleness.stats,
+                                                                   "restarts":lambda: dict(self.n_restarts)})
+        tasks = [asyncio.create_task(self.supervise("logwriter", self.logwriter)),
+                 asyncio.create_task(self.supervise("homemanager", self.homemanager)),
+                 asyncio.create_task(self.supervise("tripower", self.tripower)),
+                 ]
+        if self.log_mode == "timer":
+            tasks.append(asyncio.create_task(self.supervise("snapshots", self.snapshots)))
+        await stop.wait()
+        print("Bye!")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.mqttc.disconnect()
+        self.mqttc.loop_stop()
+        print("Disconnected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the HomeManager, Tripower and logger parts of pvpi in one process")
+    parser.add_argument("--interval", type=float, default=10.0, help="Seconds between two HomeManager publications")
+    parser.add_argument("--fanout", action="store_true",
+                        help="Also publish each field on its own topic, not only the json snapshots")
+    parser.add_argument("--log-mode", choices=["timer", "trigger"], default=None,
+                        help="Log a row every --log-interval seconds, or whenever the trigger topic arrives")
+    parser.add_argument("--log-interval", type=float, default=None, help="Seconds between rows in timer mode")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    daemon = Daemon(hm_interval=args.interval, fanout=args.fanout, log_mode=args.log_mode, log_interval=args.log_interval)
+    asyncio.run(daemon.run())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,8 +4,14 @@ https://github.com/c0deliner/venus-homemanager/blob/main/homemeanger_decoder.py
 
 Added the MQTT part.
 
+To check the decoder speed on the Pi:
+    python pvpi-homemanager.py --capture datagrams.bin --count 100
+    python pvpi-homemanager.py --benchmark datagrams.bin
+
 But values are wrong, maybe delayed, compared to what the tripower and Sunny Portal reports.
 To be investigated.
+main() now drains the socket as the datagrams arrive, so that no backlog of old datagrams can build up,
+and publishes the mean of the demands and voltages over all datagrams since the previous publication.
 
 """
 
@@ -14,14 +20,24 @@ import struct
 import logging
 import socket
 import time
+import select
+import argparse
+import json
 
 import paho.mqtt.client as mqtt
 
+import pvpi_metrics
+
 verbose = False
 
 MCAST_GRP = '239.12.255.254'
 MCAST_PORT = 9522
 
+# Socket options for the kernel receive time of each datagram, and the number of datagrams dropped by the kernel
+# (socket buffer full). Only used if this Python defines them (Linux).
+SO_TIMESTAMP = getattr(socket, "SO_TIMESTAMP", None)
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", None)
+
 
 class HomeManager20:
     OBIS_OBJECTS = {
@@ -89,61 +105,235 @@ class HomeManager20:
         0x90000000: {'measurement': 'fw_version', 'format': '>BBBc', 'scale': 1},
     }
 
-    def __init__(self):
+    # What read_data() returns (and main() publishes): key -> measurement. Only these get decoded.
+    PUBLISHED = {"psupply":"negative_active_demand",
+                 "psupplyreactive":"negative_reactive_demand",
+                 "psupplyapparent":"negative_apparent_demand",
+                 "ppurchase":"positive_active_demand",
+                 "ppurchasereactive":"positive_reactive_demand",
+                 "ppurchaseapparent":"positive_apparent_demand",
+                 "esupply":"negative_active_energy",
+                 "epurchase":"positive_active_energy",
+                 "power_factor":"power_factor",
+                 "current_transformer_ratio":"current_transformer_ratio",
+                 "v1":"voltage_L1",
+                 "v2":"voltage_L2",
+                 "v3":"voltage_L3",
+                 }
+
+    # Fields of PUBLISHED that get aggregated over a window of datagrams in the window mode
+    AGGREGATED = ["psupply", "psupplyreactive", "psupplyapparent",
+                  "ppurchase", "ppurchasereactive", "ppurchaseapparent",
+                  "v1", "v2", "v3"]
+
+    _OBIS_ID = struct.Struct('>I')
+
+    def __init__(self, measurements=None, listen=True, rcvbuf=None):
+        """
+        measurements is the set of measurements to decode, by default those needed for PUBLISHED.
+        Use measurements="all" to decode everything.
+        listen=False does not open the multicast socket (to decode given datagrams, e.g. for benchmarks).
+        rcvbuf is the socket receive buffer size in bytes (SO_RCVBUF), by default the system default.
+        """
         self.datagram = None
+        self.datagram_time = None # when the datagram was received, seconds since epoch
+        self.new_datagram = False # self.datagram was not used yet
         self.hmdata = {}
+        self.rcvbuf = rcvbuf
+
+        # Metrics of the drain mode
+        self.n_received = 0 # datagrams read from the socket
+        self.n_coalesced = 0 # datagrams replaced by a newer one before being used (latest mode)
+        self.n_dropped = 0 # datagrams dropped by the kernel, as the socket buffer was full (Linux only)
+        self.n_invalid = 0 # datagrams that could not be fully decoded
+        self.has_timestamp = False
+        self.has_rxq_ovfl = False
+        if measurements is None:
+            measurements = set(self.PUBLISHED.values())
+        self._compile(measurements)
+        if listen:
+            self._open_socket()
+
+    def _compile(self, measurements):
+        """
+        Prepares, for each OBIS ID, either a decoder (measurement, struct.Struct, scale), or the size to skip.
+        """
+        self.decoders = {}
+        self.skip_sizes = {}
+        for (obis, obj) in self.OBIS_OBJECTS.items():
+            st = struct.Struct(obj['format'])
+            if measurements == "all" or obj['measurement'] in measurements:
+                self.decoders[obis] = (obj['measurement'], st, obj['scale'])
+            else:
+                self.skip_sizes[obis] = st.size
+        self.n_measurements = len(self.decoders)
+
+    def _open_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         mreq = struct.pack("4sL", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY)
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
         self.sock.bind(('', MCAST_PORT))
+        if self.rcvbuf is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        self.has_timestamp = self._enable(SO_TIMESTAMP)
+        self.has_rxq_ovfl = self._enable(SO_RXQ_OVFL)
+
+    def _enable(self, option):
+        if option is None:
+            return False
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, option, 1)
+            return True
+        except OSError:
+            return False
 
     def _receive_data(self):
         self.datagram = self.sock.recv(1024)
 
     def _decode_data(self):
         #print(self.datagram)
-        if self.datagram[:4] != b'SMA\x00':
-            return
         self.hmdata = {}
+        data = memoryview(self.datagram) # No copies when reading
+        if data[:4] != b'SMA\x00':
+            return
+        hmdata = self.hmdata
+        decoders = self.decoders
+        skip_sizes = self.skip_sizes
+        unpack_obis = self._OBIS_ID.unpack_from
+        n = len(data)
         i = 4
-        while i < len(self.datagram):
-            obis = struct.unpack('>I', self.datagram[i:i + 4])[0]
+        while i + 4 <= n:
+            obis = unpack_obis(data, i)[0]
             i += 4
-            if obis > 0:
-                try:
-                    key = self.OBIS_OBJECTS[obis]['measurement']
-                    size = struct.calcsize(self.OBIS_OBJECTS[obis]['format'])
-                    values = struct.unpack(self.OBIS_OBJECTS[obis]['format'], self.datagram[i:i + size])
-                    if key != 'fw_version':
-                        value = values[0] / self.OBIS_OBJECTS[obis]['scale']
-                    else:
-                        value = f'{values[0]}.{values[1]}.{values[2]}.{values[3].decode()}'
-                    self.hmdata.update({key: value})
-                    i += size
-                except KeyError:
-                    logging.debug(f'Unknown OBIS ID: 0x{obis:08x}')
-                    i += 4
+            if obis == 0:
+                continue
+            decoder = decoders.get(obis)
+            if decoder is not None:
+                (key, st, scale) = decoder
+                if i + st.size > n:
+                    break
+                values = st.unpack_from(data, i)
+                if key != 'fw_version':
+                    hmdata[key] = values[0] / scale
+                else:
+                    hmdata[key] = f'{values[0]}.{values[1]}.{values[2]}.{values[3].decode()}'
+                i += st.size
+                continue
+            size = skip_sizes.get(obis)
+            if size is None:
+                # Unknown OBIS ID: the third byte is the type, giving the length of the value
+                size = (obis >> 8) & 0xff
+                if size not in (4, 8):
+                    logging.debug(f'Unknown OBIS ID with unknown length: 0x{obis:08x}')
                     return
+                logging.debug(f'Skipping unknown OBIS ID: 0x{obis:08x}')
+            i += size
+
+    def drain(self, callback=None):
+        """
+        Reads all datagrams waiting in the socket buffer without blocking, and keeps only the newest one
+        (in self.datagram, with its receive time in self.datagram_time).
+        The receive time is the one of the kernel (SO_TIMESTAMP) if available, otherwise the time when it gets read here,
+        see wait().
+        If given, callback(datagram, receive time) is called for each datagram, otherwise the datagrams that
+        were not used are counted as coalesced.
+        Returns the number of datagrams read.
+        """
+        n = 0
+        while True:
+            try:
+                (data, ancdata, flags, address) = self.sock.recvmsg(2048, socket.CMSG_SPACE(4) + socket.CMSG_SPACE(16),
+                                                                    socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            rxtime = time.time()
+            for (level, kind, cdata) in ancdata:
+                if level != socket.SOL_SOCKET:
+                    continue
+                if kind == SO_TIMESTAMP and len(cdata) in (8, 16):
+                    # struct timeval, with 32 or 64 bit fields
+                    (seconds, microseconds) = struct.unpack('=ii' if len(cdata) == 8 else '=qq', cdata)
+                    rxtime = seconds + microseconds / 1e6
+                elif kind == SO_RXQ_OVFL and len(cdata) >= 4:
+                    # Total count since the socket was opened, as known when this datagram was queued
+                    self.n_dropped = struct.unpack('=I', cdata[:4])[0]
+            if callback is not None:
+                callback(data, rxtime)
+            elif self.new_datagram:
+                self.n_coalesced += 1
+            self.datagram = data
+            self.datagram_time = rxtime
+            self.new_datagram = callback is None
+            n += 1
+        self.n_received += n
+        return n
+
+    def wait(self, until, aggregator=None):
+        """
+        Waits until the time until (seconds since epoch), draining the socket whenever datagrams arrive,
+        into the WindowAggregator if given (see read_window()), otherwise keeping the newest one (see read_latest()).
+        Without kernel timestamps, the receive times are so still those of the arrival.
+        """
+        while True:
+            remaining = until - time.time()
+            if remaining <= 0:
+                return
+            if select.select([self.sock], [], [], remaining)[0]:
+                if aggregator is None:
+                    self.drain()
+                else:
+                    self.read_window(aggregator)
 
+    @pvpi_metrics.timed("HomeManager20.read_latest")
+    def read_latest(self):
+        """
+        Drains the socket, and returns (dict, receive time) for the newest datagram,
+        or ({}, None) if no new (valid) datagram arrived since the last call.
+        """
+        self.drain()
+        if not self.new_datagram:
+            return ({}, None)
+        self.new_datagram = False
+        d = self._simplify()
+        if len(d) == 0:
+            self.n_invalid += 1
+            return ({}, None)
+        return (d, self.datagram_time)
+
+    @pvpi_metrics.timed("HomeManager20.read_window")
+    def read_window(self, aggregator):
+        """
+        Drains the socket, decoding every datagram into the WindowAggregator.
+        Returns the number of datagrams added.
+        """
+        n_before = aggregator.n
+        def add(datagram, rxtime):
+            self.datagram = datagram
+            d = self._simplify()
+            if len(d) == 0:
+                self.n_invalid += 1
+            else:
+                aggregator.add(d, rxtime)
+        self.drain(callback=add)
+        return aggregator.n - n_before
+
+    def metrics(self):
+        return {"received":self.n_received,
+                "coalesced":self.n_coalesced,
+                "dropped":self.n_dropped if self.has_rxq_ovfl else None,
+                "invalid":self.n_invalid,
+                }
+
+    @pvpi_metrics.timed("HomeManager20.read_data")
     def read_data(self):
         self._receive_data()
+        return self._simplify()
+
+    def _simplify(self):
         self._decode_data()
-        if len(self.hmdata) == 62:
-            simplified_dict = {"psupply":self.hmdata["negative_active_demand"],
-                               "psupplyreactive":self.hmdata["negative_reactive_demand"],
-                               "psupplyapparent":self.hmdata["negative_apparent_demand"],
-                               "ppurchase":self.hmdata["positive_active_demand"],
-                               "ppurchasereactive":self.hmdata["positive_reactive_demand"],
-                               "ppurchaseapparent":self.hmdata["positive_apparent_demand"],
-                               "esupply":self.hmdata["negative_active_energy"],
-                               "epurchase":self.hmdata["positive_active_energy"],
-                               "power_factor":self.hmdata["power_factor"],
-                               "current_transformer_ratio":self.hmdata["current_transformer_ratio"],
-                               "v1":self.hmdata["voltage_L1"],
-                               "v2":self.hmdata["voltage_L2"],
-                               "v3":self.hmdata["voltage_L3"]
-                            }
+        if len(self.hmdata) == self.n_measurements: # All measurements were found
+            simplified_dict = {key:self.hmdata[measurement] for (key, measurement) in self.PUBLISHED.items()}
             return simplified_dict
         else:
             if verbose:
@@ -152,33 +342,186 @@ class HomeManager20:
         
 
 
-def main():
+class WindowAggregator:
+    """
+    Mean, min, max and last value of some fields over a window of datagrams, in constant memory.
+    Other fields are just kept at their last value.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.stats = {field:[0.0, float("inf"), float("-inf")] for field in self.fields} # sum, min, max
+        self.last = {}
+        self.last_time = None
+
+    def add(self, d, rxtime):
+        self.n += 1
+        for field in self.fields:
+            value = d[field]
+            stats = self.stats[field]
+            stats[0] += value
+            if value < stats[1]:
+                stats[1] = value
+            if value > stats[2]:
+                stats[2] = value
+        self.last = d
+        self.last_time = rxtime
+
+    def values(self):
+        """
+        dict with the window mean of the aggregated fields, and the last value of the others.
+        """
+        if self.n == 0:
+            return {}
+        d = dict(self.last)
+        for field in self.fields:
+            d[field] = self.stats[field][0] / self.n
+        return d
+
+    def summary(self):
+        """
+        dict with the number of datagrams, the receive time of the last one,
+        and for each aggregated field a dict of mean, min, max and last.
+        """
+        summary = {"n":self.n, "time":self.last_time}
+        for field in self.fields:
+            (total, vmin, vmax) = self.stats[field]
+            summary[field] = {"mean":total / self.n, "min":vmin, "max":vmax, "last":self.last[field]}
+        return summary
+
+
+def publish(mqttc, d, extra=None, fanout=False):
+    """
+    Publishes the reading d as one json message on SMAHomeManager/snapshot (with the extra dict merged in),
+    and if fanout also each field of d and of extra on its own topic.
+    Only the last message is waited for.
+    """
+    snapshot = dict(d)
+    if extra is not None:
+        snapshot.update(extra)
+    msg_info = mqttc.publish("SMAHomeManager/snapshot", json.dumps(snapshot, separators=(",", ":")), qos=0)
+    if fanout:
+        for (key, value) in snapshot.items():
+            if isinstance(value, dict):
+                value = json.dumps(value, separators=(",", ":"))
+            msg_info = mqttc.publish(f"SMAHomeManager/{key}", value, qos=0)
+    msg_info.wait_for_publish()
+
+
+def capture(path, count):
+    """
+    Writes count received datagrams to the file path (each prefixed by its length as 4-byte big-endian).
+    """
     sma = HomeManager20()
+    with open(path, "wb") as f:
+        for i in range(count):
+            sma._receive_data()
+            f.write(struct.pack('>I', len(sma.datagram)) + sma.datagram)
+    print(f"Captured {count} datagrams to {path}")
+
+
+def read_capture(path):
+    datagrams = []
+    with open(path, "rb") as f:
+        data = f.read()
+    i = 0
+    while i < len(data):
+        size = struct.unpack_from('>I', data, i)[0]
+        datagrams.append(data[i + 4:i + 4 + size])
+        i += 4 + size
+    return datagrams
+
+
+def benchmark(path, repeat=1000):
+    """
+    Decodes the captured datagrams repeatedly, and prints the packets per second,
+    for the published measurements only and for all of them.
+    """
+    datagrams = read_capture(path)
+    for measurements in (None, "all"):
+        sma = HomeManager20(measurements=measurements, listen=False)
+        starttime = time.perf_counter()
+        for i in range(repeat):
+            for datagram in datagrams:
+                sma.datagram = datagram
+                sma._decode_data()
+        duration = time.perf_counter() - starttime
+        print(f"Decoding {'all' if measurements else 'published'} measurements: "
+              f"{repeat * len(datagrams) / duration:.0f} packets/s ({len(sma.hmdata)} values per packet)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publishes the SMA HomeManager multicast data to MQTT")
+    parser.add_argument("--capture", metavar="FILE", help="Capture datagrams to FILE instead of publishing")
+    parser.add_argument("--count", type=int, default=100, help="Number of datagrams to capture")
+    parser.add_argument("--benchmark", metavar="FILE", help="Benchmark the decoder on the datagrams captured in FILE")
+    parser.add_argument("--interval", type=float, default=10.0, help="Seconds between two publications (default: 10)")
+    parser.add_argument("--rcvbuf", type=int, default=None, help="Socket receive buffer size in bytes")
+    parser.add_argument("--mode", choices=["window", "latest"], default="window",
+                        help="Publish window means (default), or only the latest datagram")
+    parser.add_argument("--fanout", action="store_true",
+                        help="Also publish each field on its own topic, not only the json snapshot")
+    args = parser.parse_args()
+
+    if args.capture:
+        capture(args.capture, args.count)
+        return 0
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return 0
+
+    sma = HomeManager20(rcvbuf=args.rcvbuf)
+    aggregator = WindowAggregator(HomeManager20.AGGREGATED)
 
     broker = "heizung.local"
     port = 1883
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     mqttc.connect(broker, port)
     mqttc.loop_start()
+    pvpi_metrics.start_publisher(mqttc, "homemanager", gauges={"socket":sma.metrics})
 
     try:
+        # Publish at a fixed cadence, aligned to the wall clock, draining the socket buffer whenever datagrams arrive
+        # in between, so nothing old piles up in it.
+        # "latest" mode: only the newest datagram is used.
+        # "window" mode: the demands and voltages are the mean over all datagrams of the window,
+        # and their mean/min/max/last are added to the snapshot, as "window".
+        next_time = time.time()
+        next_metrics_time = next_time + 60
         while True:
-            for i in range(10):
-                d = sma.read_data()
-                #print("tick")
+            next_time += args.interval
+            sma.wait(next_time, aggregator if args.mode == "window" else None)
+            extra = None
+            if args.mode == "latest":
+                (d, rxtime) = sma.read_latest()
+            else:
+                sma.read_window(aggregator)
+                d = aggregator.values()
+                rxtime = aggregator.last_time
+                if len(d) > 0:
+                    extra = {"window":aggregator.summary()}
+                aggregator.reset()
             #print(d)
-            for (key, value) in d.items():
-                msg_info = mqttc.publish(f"SMAHomeManager/{key}", value, qos=0)
-                msg_info.wait_for_publish()
+            if len(d) > 0:
+                d["time"] = round(rxtime, 3) # Receive time (of the last datagram), seconds since epoch
+                publish(mqttc, d, extra, fanout=args.fanout)
 
-            #time.sleep(5)
+            if time.time() > next_metrics_time:
+                mqttc.publish("SMAHomeManager/metrics", json.dumps(sma.metrics()), qos=0)
+                if verbose:
+                    print(sma.metrics())
+                next_metrics_time += 60
 
     except KeyboardInterrupt:
         print("Bye!")
         mqttc.disconnect()
         mqttc.loop_stop()
 
-    
+
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+Controls the SG-Ready input of the heat pump via a Shelly relay, when excess PV power is available.
+
+The surplus is the power fed into the grid (psupply - ppurchase), from the HomeManager and the Tripower
+(json snapshots or single topics), averaged over a sliding time window. A sample is only taken once both
+values of a source are new (a snapshot, or both single topics).
+Each new sample gets evaluated immediately:
+- the relay switches on when the mean surplus is at least on_threshold,
+- and off when it is at most off_threshold (below on_threshold: the hysteresis band in between changes nothing),
+- but each state is kept for at least min_on / min_off seconds,
+- and it switches off without waiting when no data came for stale seconds.
+The relay gets switched by a worker thread, so that the MQTT thread never waits for it. If the relay is not
+reachable, the switching is tried again after retry seconds, doubling up to max_retry.
+
+To measure the switching latency without hardware (uses pvpi_fakeshelly.py):
+    python pvpi-sgready.py --selftest
+"""
+
+import sys
+import time
+import json
+import argparse
+import collections
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import paho.mqtt.client as mqtt
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Topic -> (source, field)
+sample_topics = {
+    "SMAHomeManager/psupply":("SMAHomeManager", "psupply"),
+    "SMAHomeManager/ppurchase":("SMAHomeManager", "ppurchase"),
+    "SMATripower/psupply":("SMATripower", "psupply"),
+    "SMATripower/ppurchase":("SMATripower", "ppurchase"),
+    }
+snapshot_topics = {
+    "SMAHomeManager/snapshot":"SMAHomeManager",
+    "SMATripower/snapshot":"SMATripower",
+    }
+status_topic = "VitocalOpen3E/SmartGridReadyConsolidator/OperatingStatus"
+state_topic = "SGReady/state"
+
+
+class SlidingMean:
+    """
+    Mean of the values added during the last window seconds, with O(1) (amortized) work per value.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = collections.deque()
+        self.total = 0.0
+
+    def add(self, t, value):
+        self.samples.append((t, value))
+        self.total += value
+        self.evict(t)
+
+    def evict(self, t):
+        samples = self.samples
+        limit = t - self.window
+        while samples and samples[0][0] <= limit:
+            self.total -= samples.popleft()[1]
+        if not samples:
+            self.total = 0.0 # No rounding errors accumulate
+
+    def __len__(self):
+        return len(self.samples)
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return self.total / len(self.samples)
+
+
+class ShellyRelay:
+    """
+    Switches a Shelly relay (Gen1 http API) over a persistent connection.
+    """
+
+    def __init__(self, url, connect_timeout=2.0, read_timeout=5.0):
+        self.url = url.rstrip("/") + "/relay/0"
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=1))
+        self.n_errors = 0
+        self.last_latency = None
+
+    def set(self, on):
+        """
+        Switches, and returns the state reported by the relay (or None in case of an error).
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.get(self.url, params={"turn":"on" if on else "off"}, timeout=self.timeout)
+            response.raise_for_status()
+            ison = response.json()["ison"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.n_errors += 1
+            logger.error(f"Could not switch the relay: {e}")
+            return None
+        self.last_latency = time.perf_counter() - start
+        return ison
+
+    def close(self):
+        self.session.close()
+
+
+class SGReadyController:
+
+    fields = ("psupply", "ppurchase")
+
+    def __init__(self, relay, on_threshold=1500.0, off_threshold=0.0, window=120.0,
+                 min_on=600.0, min_off=600.0, stale=120.0, min_samples=3, retry=10.0, max_retry=300.0):
+        """
+        Thresholds in W of surplus, times in seconds.
+        start() starts the worker thread switching the relay.
+        """
+        if off_threshold >= on_threshold:
+            raise ValueError("off_threshold must be below on_threshold")
+        self.relay = relay
+        self.on_threshold = on_threshold
+        self.off_threshold = off_threshold
+        self.min_on = min_on
+        self.min_off = min_off
+        self.stale = stale
+        self.min_samples = min_samples
+        self.retry = retry
+        self.max_retry = max_retry
+        self.surplus = SlidingMean(window)
+        self.latest = {} # source -> {"psupply":..., "ppurchase":...}
+        self.fresh = {} # source -> set of the fields updated since its last sample
+        self.operating_status = None
+        self.state = None # Unknown until the first switching
+        self.last_switch = None
+        self.last_sample = None
+        self.n_switches = 0
+        self.n_failures = 0 # Consecutive failed switchings
+        self.request = None # (on, reason) for the worker, until it is done
+        self.retry_time = None # No new request before this time, after a failure
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self.work, name="SGReadyRelay", daemon=True)
+        self.on_switch = None # Called with the state dict after each switching
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.wakeup.notify()
+        self.thread.join()
+
+    def add_sample(self, source, values, t):
+        """
+        Takes new values (dict with psupply and/or ppurchase) of a source at time t (time.monotonic()),
+        and requests a switching if needed. The values count as a sample once both fields are new.
+        """
+        with self.lock:
+            latest = self.latest.setdefault(source, {})
+            latest.update(values)
+            fresh = self.fresh.setdefault(source, set())
+            fresh.update(values)
+            if len(fresh) < len(self.fields):
+                return
+            fresh.clear()
+            self.surplus.add(t, latest["psupply"] - latest["ppurchase"])
+            self.last_sample = t
+            self.decide(t)
+
+    def set_operating_status(self, status):
+        with self.lock:
+            self.operating_status = status
+
+    def decide(self, t):
+        mean = self.surplus.mean()
+        since = None if self.last_switch is None else t - self.last_switch
+        if self.state is None:
+            # Start from a known state
+            self.switch(mean is not None and mean >= self.on_threshold and len(self.surplus) >= self.min_samples,
+                        t, "start")
+        elif not self.state:
+            if len(self.surplus) >= self.min_samples and mean >= self.on_threshold and since >= self.min_off:
+                self.switch(True, t, "surplus")
+        else:
+            if mean is not None and mean <= self.off_threshold and since >= self.min_on:
+                self.switch(False, t, "no surplus")
+
+    def check(self, t):
+        """
+        To be called regularly: switches off if the data got stale.
+        """
+        with self.lock:
+            self.surplus.evict(t)
+            if self.state and (self.last_sample is None or t - self.last_sample > self.stale):
+                self.switch(False, t, "stale data")
+
+    def switch(self, on, t, reason):
+        """Requests the worker to switch, with the lock held. Nothing happens while a switching is under way."""
+        if self.request is not None or (self.retry_time is not None and t < self.retry_time):
+            return
+        self.request = (on, reason)
+        self.wakeup.notify()
+
+    def work(self):
+        """The worker thread: switches the relay as requested, without holding the lock meanwhile."""
+        while True:
+            with self.lock:
+                while self.request is None and not self.stopping:
+                    self.wakeup.wait()
+                if self.stopping:
+                    return
+                (on, reason) = self.request
+            ison = self.relay.set(on)
+            with self.lock:
+                self.request = None
+                t = time.monotonic()
+                if ison is None: # Relay not reachable
+                    self.n_failures += 1
+                    delay = min(self.max_retry, self.retry * 2 ** (self.n_failures - 1))
+                    self.retry_time = t + delay
+                    logger.warning(f"Switching SG-Ready {'on' if on else 'off'} failed, next try in {delay:.0f} s at the earliest")
+                    continue
+                self.n_failures = 0
+                self.retry_time = None
+                self.state = ison
+                self.last_switch = t
+                self.n_switches += 1
+                logger.info(f"Switched SG-Ready {'on' if ison else 'off'} ({reason}, surplus {self.surplus.mean()})")
+                if self.on_switch is not None:
+                    self.on_switch(self.status(reason))
+
+    def status(self, reason=None):
+        return {"on":self.state,
+                "reason":reason,
+                "surplus":self.surplus.mean(),
+                "samples":len(self.surplus),
+                "operating_status":self.operating_status,
+                "switches":self.n_switches,
+                "relay_latency":self.relay.last_latency,
+                "relay_errors":self.relay.n_errors,
+                "relay_failures":self.n_failures,
+                }
+
+
+def on_connect(client, controller, flags, reason_code, properties):
+    if reason_code.is_failure:
+        print(f"Failed to connect: {reason_code}. loop_forever() will retry connection")
+    else:
+        for topic in list(sample_topics) + list(snapshot_topics) + [status_topic]:
+            client.subscribe(topic)
+
+
+def on_message(client, controller, message):
+    t = time.monotonic()
+    topic = message.topic
+    try:
+        if topic in snapshot_topics:
+            snapshot = json.loads(message.payload)
+            values = {key:float(snapshot[key]) for key in ("psupply", "ppurchase") if snapshot.get(key) is not None}
+            controller.add_sample(snapshot_topics[topic], values, t)
+        elif topic in sample_topics:
+            (source, field) = sample_topics[topic]
+            controller.add_sample(source, {field:float(message.payload)}, t)
+        elif topic == status_topic:
+            controller.set_operating_status(float(message.payload))
+    except ValueError:
+        logger.warning(f"Could not decode {topic}: {message.payload}")
+
+
+def run(args):
+    relay = ShellyRelay(args.shelly)
+    controller = SGReadyController(relay, on_threshold=args.on, off_threshold=args.off, window=args.window,
+                                   min_on=args.min_on, min_off=args.min_off, stale=args.stale,
+                                   min_samples=args.min_samples)
+
+    broker = "heizung.local"
+    port = 1883
+    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+    mqttc.user_data_set(controller)
+    controller.on_switch = lambda status: mqttc.publish(state_topic, json.dumps(status), qos=1, retain=True)
+    controller.start()
+    mqttc.connect(broker, port)
+    mqttc.loop_start()
+
+    try:
+        while True:
+            time.sleep(5)
+            controller.check(time.monotonic())
+
+    except KeyboardInterrupt:
+        print("Bye!")
+        mqttc.disconnect()
+        mqttc.loop_stop()
+        controller.stop()
+        relay.close()
+
+
+def wait_for_switches(shelly, n, timeout=5.0):
+    limit = time.monotonic() + timeout
+    while len(shelly.switches) < n:
+        if time.monotonic() > limit:
+            raise RuntimeError("The relay did not switch")
+        time.sleep(0.0002)
+
+
+def selftest(n=200):
+    """
+    Measures the latency from the arrival of a sample to the switching of a (fake, local) relay,
+    including the handover to the worker thread.
+    """
+    import pvpi_fakeshelly
+    shelly = pvpi_fakeshelly.FakeShelly().start()
+    relay = ShellyRelay(shelly.url)
+    # The window is shorter than the time between samples, so that each sample decides alone
+    controller = SGReadyController(relay, on_threshold=1000.0, off_threshold=0.0, window=0.005,
+                                   min_on=0.0, min_off=0.0, min_samples=1).start()
+    controller.add_sample("test", {"psupply":0.0, "ppurchase":0.0}, time.monotonic())
+    wait_for_switches(shelly, 1)
+
+    latencies = []
+    for i in range(n):
+        time.sleep(0.01)
+        start = time.monotonic()
+        controller.add_sample("test", {"psupply":5000.0 if i % 2 == 0 else -5000.0, "ppurchase":0.0}, start)
+        wait_for_switches(shelly, i + 2)
+        (switch_time, ison) = shelly.switches[-1]
+        if ison != (i % 2 == 0):
+            raise RuntimeError("The relay did not switch")
+        latencies.append(switch_time - start)
+
+    controller.stop()
+    relay.close()
+    shelly.stop()
+    latencies.sort()
+    print(f"{n} switchings, latency sample to relay: "
+          f"p50 {1000 * latencies[n // 2]:.2f} ms, p99 {1000 * latencies[int(0.99 * n)]:.2f} ms, "
+          f"max {1000 * latencies[-1]:.2f} ms, {shelly.n_requests} requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SG-Ready control of the heat pump via a Shelly relay")
+    parser.add_argument("--shelly", default="http://shelly-sgready.local", help="Base url of the Shelly relay")
+    parser.add_argument("--on", type=float, default=1500.0, help="Switch on at this mean surplus (W)")
+    parser.add_argument("--off", type=float, default=0.0, help="Switch off at this mean surplus (W)")
+    parser.add_argument("--window", type=float, default=120.0, help="Seconds over which the surplus gets averaged")
+    parser.add_argument("--min-on", type=float, default=600.0, help="Minimum seconds to stay on")
+    parser.add_argument("--min-off", type=float, default=600.0, help="Minimum seconds to stay off")
+    parser.add_argument("--stale", type=float, default=120.0, help="Switch off when no sample came for these seconds")
+    parser.add_argument("--min-samples", type=int, default=3, help="Samples in the window needed to switch on")
+    parser.add_argument("--selftest", action="store_true", help="Measure the switching latency with a fake relay")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.selftest:
+        logger.setLevel(logging.WARNING)
+        selftest()
+    else:
+        run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,8 @@
 import sys
+import argparse
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import warnings
 import urllib3
 import json
@@ -7,59 +10,222 @@ import time
 
 import paho.mqtt.client as mqtt
 
+import pvpi_metrics
+
 verbose = False
 
-def read_tripower():
+
+class TripowerClient:
     """
+    Reads the dashboard values of the Tripower inverter over a persistent https connection
+    (keep-alive, one pooled connection), with connect/read timeouts and jittered exponential backoff on errors.
     """
 
-    tripower_json_url = "https://192.168.0.34/dyn/getDashValues.json"
+    def __init__(self, url="https://192.168.0.34/dyn/getDashValues.json",
+                 connect_timeout=3.05, read_timeout=10.0, min_backoff=2.0, max_backoff=300.0):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=urllib3.exceptions.InsecureRequestWarning)
-        got_response = False
-        while got_response == False:
-            try:
-                response = requests.get(tripower_json_url, verify=False)
-                got_response = True
-            except Exception as e:
-                print("Error in http request:")
-                print(e)
-                print("Retry in 60 s")
-                time.sleep(60)
+        self.session = requests.Session()
+        self.session.verify = False # The inverter has a self-signed certificate
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
 
+        self.n_failures = 0 # Consecutive failed requests, for the backoff
+        self.n_requests = 0
+        self.n_errors = 0 # Failed requests (connection errors, timeouts)
+        self.n_bad_status = 0
+        self.n_parsing_issues = 0
+        self.response_time = None # time.time() when the last successful response arrived
+        self._reset_latency()
 
+    def _reset_latency(self):
+        self.latency_n = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
 
-    if response.status_code != 200:
-        dict = {"tripower_respons_status": response.status_code}
-        print(dict)
-        return(dict)
+    def _pool_counts(self):
+        """(new connections, requests) over the connection pools of the adapter"""
+        pools = self.adapter.poolmanager.pools
+        n_connections = 0
+        n_requests = 0
+        for key in pools.keys():
+            pool = pools[key]
+            n_connections += pool.num_connections
+            n_requests += pool.num_requests
+        return (n_connections, n_requests)
 
-    try:
-        dashvals = response.json()["result"]["01B8-xxxxx788"] # Get rid of some wrapper
-        #print(json.dumps(dashvals, indent="  "))
-        #print(json.dumps(dashvals))
-    
-        parsed = {"psupply":dashvals["6100_40463600"]["9"][0]["val"],
-                  "ppurchase":dashvals["6100_40463700"]["9"][0]["val"],
-                  "pgenerate":dashvals["6100_0046C200"]["9"][0]["val"],
-                  "esupply":dashvals["6400_00462400"]["9"][0]["val"]/1000.0,
-                  "epurchase":dashvals["6400_00462500"]["9"][0]["val"]/1000.0,
-                  }
-        parsed["pconsume"] = max(parsed["pgenerate"] + parsed["ppurchase"] - parsed["psupply"], 0)
-        # This does not work well when the weather is rapidly changing, as these measurements are not simultaneous it seems.
-
-        if verbose:
-            print(parsed)
-        return parsed
-
-    except (TypeError, KeyError):
-        print("Issue with data:", dashvals)
-        return {"tripower_parsing_issue":1}
-    #print(parsed)
+    def backoff(self):
+        """Seconds to wait after the current number of consecutive failures, with equal jitter (half to all of the delay)."""
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self.n_failures - 1))
+        return random.uniform(0.5 * delay, delay)
+
+    @pvpi_metrics.timed("TripowerClient.try_fetch")
+    def try_fetch(self):
+        """
+        Makes one request, returns the response, or None if it failed.
+        The time when the response arrived is kept in self.response_time, for parse().
+        """
+        self.n_requests += 1
+        start = time.perf_counter()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=urllib3.exceptions.InsecureRequestWarning)
+                response = self.session.get(self.url, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.n_errors += 1
+            self.n_failures += 1
+            print(f"Error in http request: {e}")
+            return None
+        self.response_time = time.time()
+        latency = time.perf_counter() - start
+        self.latency_n += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.n_failures = 0
+        return response
+
+    def fetch(self):
+        """
+        Gets the response, retrying with backoff until there is one.
+        """
+        while True:
+            response = self.try_fetch()
+            if response is not None:
+                return response
+            delay = self.backoff()
+            print(f"Retry in {delay:.0f} s")
+            time.sleep(delay)
+
+    @pvpi_metrics.timed("read_tripower")
+    def read(self):
+        """
+        Returns the dict of parsed values (or of the issue, see below).
+        """
+        return self.parse(self.fetch())
+
+    def parse(self, response):
+        """
+        Returns the dict of parsed values of the response (or of the issue).
+        The parsed values get the "time" of the reading: when the response arrived, seconds since epoch.
+        The dicts of issues have no time, so that they do not update SMATripower/time without any values.
+        """
+        if response.status_code != 200:
+            self.n_bad_status += 1
+            dict = {"tripower_respons_status": response.status_code}
+            print(dict)
+            return(dict)
+
+        dashvals = None
+        try:
+            dashvals = response.json()["result"]["01B8-xxxxx788"] # Get rid of some wrapper
+            #print(json.dumps(dashvals, indent="  "))
+            #print(json.dumps(dashvals))
+
+            parsed = {"psupply":dashvals["6100_40463600"]["9"][0]["val"],
+                      "ppurchase":dashvals["6100_40463700"]["9"][0]["val"],
+                      "pgenerate":dashvals["6100_0046C200"]["9"][0]["val"],
+                      "esupply":dashvals["6400_00462400"]["9"][0]["val"]/1000.0,
+                      "epurchase":dashvals["6400_00462500"]["9"][0]["val"]/1000.0,
+                      }
+            parsed["pconsume"] = max(parsed["pgenerate"] + parsed["ppurchase"] - parsed["psupply"], 0)
+            # This does not work well when the weather is rapidly changing, as these measurements are not simultaneous it seems.
+            if self.response_time is not None:
+                parsed["time"] = round(self.response_time, 3)
+
+            if verbose:
+                print(parsed)
+            return parsed
+
+        except (TypeError, KeyError, ValueError):
+            self.n_parsing_issues += 1
+            print("Issue with data:", dashvals)
+            return {"tripower_parsing_issue":1}
+
+    def metrics(self):
+        """
+        Returns a dict of counters, and of the latency since the previous call (which resets it).
+        handshake_reuse is the fraction of requests that did not need a new connection.
+        """
+        (n_connections, n_pool_requests) = self._pool_counts()
+        d = {"n_requests":self.n_requests,
+             "n_errors":self.n_errors,
+             "n_bad_status":self.n_bad_status,
+             "n_parsing_issues":self.n_parsing_issues,
+             "n_connections":n_connections,
+             "handshake_reuse":round(1.0 - n_connections / n_pool_requests, 4) if n_pool_requests > 0 else None,
+             "latency_mean":round(self.latency_sum / self.latency_n, 4) if self.latency_n > 0 else None,
+             "latency_max":round(self.latency_max, 4),
+             }
+        self._reset_latency()
+        return d
+
+    def close(self):
+        self.session.close()
+
+
+class PollInterval:
+    """
+    Adapts the polling interval: fast while the PV generation changes quickly, slow at night (pgenerate is 0).
+    The night interval must stay below log_max_age of mqtt-logger.py (30 s) and the SMATripower tolerance
+    of pvpi_align, otherwise the values go stale between two readings.
+    """
+
+    def __init__(self, normal=3.0, fast=1.0, night=20.0, fast_change=100.0):
+        self.normal = normal
+        self.fast = fast
+        self.night = night
+        self.fast_change = fast_change # W/s of pgenerate above which we poll fast
+        self.last_pgenerate = None
+        self.last_time = None
+
+    def next(self, d, now):
+        """
+        Returns the seconds to wait after having read d (at time now).
+        """
+        pgenerate = d.get("pgenerate")
+        if pgenerate is None: # Issue with the data, just continue normally
+            return self.normal
+        interval = self.normal
+        if pgenerate == 0:
+            interval = self.night
+        elif self.last_pgenerate is not None and now > self.last_time:
+            if abs(pgenerate - self.last_pgenerate) / (now - self.last_time) > self.fast_change:
+                interval = self.fast
+        self.last_pgenerate = pgenerate
+        self.last_time = now
+        return interval
+
+
+def publish(mqttc, d, fanout=False):
+    """
+    Publishes the reading d as one json message on SMATripower/snapshot,
+    and if fanout also each field on its own topic.
+    Only the last message is waited for.
+    """
+    msg_info = mqttc.publish("SMATripower/snapshot", json.dumps(d, separators=(",", ":")), qos=0)
+    if fanout:
+        for (key, value) in d.items():
+            msg_info = mqttc.publish(f"SMATripower/{key}", value, qos=0)
+    msg_info.wait_for_publish()
+
+
+_client = None
+
+def read_tripower():
+    """
+    Reads the values once, with a module-wide TripowerClient.
+    """
+    global _client
+    if _client is None:
+        _client = TripowerClient()
+    return _client.read()
     
     
-def run():
+def run(fanout=False):
 
     
     broker = "heizung.local"
@@ -67,27 +233,39 @@ def run():
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     mqttc.connect(broker, port)
     mqttc.loop_start()
+    pvpi_metrics.start_publisher(mqttc, "tripower")
+
+    client = TripowerClient()
+    poll = PollInterval()
+    next_metrics_time = time.time() + 60
 
     try:
         while True:
-        
-            d = read_tripower()
-            for (key, value) in d.items():
-                msg_info = mqttc.publish(f"SMATripower/{key}", value, qos=0)
-                msg_info.wait_for_publish()
+            start = time.time()
+            d = client.read()
+            publish(mqttc, d, fanout=fanout)
+
+            if time.time() >= next_metrics_time:
+                mqttc.publish("SMATripower/metrics", json.dumps(client.metrics()), qos=0)
+                next_metrics_time += 60
 
-            time.sleep(3)
+            time.sleep(max(poll.next(d, start) - (time.time() - start), 0))
         
 
     except KeyboardInterrupt:
         print("Bye!")
+        client.close()
         mqttc.disconnect()
         mqttc.loop_stop()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Publishes the SMA Tripower dashboard values to MQTT")
+    parser.add_argument("--fanout", action="store_true",
+                        help="Also publish each field on its own topic, not only the json snapshot")
+    args = parser.parse_args()
     #read_tripower()
-    run()
+    run(fanout=args.fanout)
     return 0
 
 if __name__ == '__main__':
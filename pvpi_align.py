@@ -0,0 +1,310 @@
+"""
+As-of alignment of the logged sources (HomeManager, Tripower, open3e) to a common time grid, with NumPy.
+
+Each logged row holds the latest values of every source, plus the time of the reading they come from
+(the <source>_time columns, see log_topic_types in mqtt-logger.py), so the values of a row are not simultaneous.
+Each source is hence first reduced to its own readings (readings()), which then get aligned to the grid
+(asof()): for each grid time, the last reading until then ("previous"), the nearest one ("nearest"),
+or the linear interpolation between the readings around it ("linear"), and nan if the reading(s) used
+are more than tolerance seconds away.
+Quantities combining sources, such as the household consumption, are computed from the aligned series (derive()).
+
+    import pvpi_align
+    data = pvpi_align.load_db("/home/mtewes/data/pvpi.db", start, end)
+    grid = pvpi_align.make_grid(start, end, step=1.0)
+    aligned = pvpi_align.align(data, grid, cols=pvpi_align.derive_cols, method="linear")
+    derived = pvpi_align.derive(aligned)
+
+Each aligned col is a float64 array of the length of the grid (a week at 1 s: 4.8 MB),
+so only the needed cols should get aligned.
+
+As a script, comparing the derived household consumption with the one reported by the Tripower:
+    python pvpi_align.py /home/mtewes/data/pvpi.db --hours 24
+
+Needs numpy.
+"""
+
+import sys
+import sqlite3
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+methods = ("previous", "nearest", "linear")
+
+# Source -> default tolerance in seconds, about twice the interval between its readings
+# (the Tripower gets polled every 20 s at night, see PollInterval in pvpi-tripower.py)
+tolerances = {"SMAHomeManager":25.0, "SMATripower":25.0, "VitocalOpen3E":40.0}
+
+# The cols needed by derive()
+derive_cols = ["SMATripower_pgenerate", "SMAHomeManager_psupply", "SMAHomeManager_ppurchase",
+               "VitocalOpen3E_CurrentElectricalPowerConsumptionSystem"]
+
+# Cols that are states, not measurements: never interpolated
+step_cols = ["VitocalOpen3E_SmartGridReadyConsolidator_OperatingStatus",
+             "VitocalOpen3E_FourThreeWayValveValveCurrentPosition",
+             "VitocalOpen3E_HeatPumpCompressorStatistical_starts",
+             ]
+
+
+def source_of(col):
+    """The source of a col, e.g. "SMATripower" for "SMATripower_pgenerate" """
+    return col.split("_", 1)[0]
+
+
+def to_seconds(date):
+    """Seconds since epoch of a datetime (naive ones are taken as UTC), or of a number of seconds"""
+    if isinstance(date, datetime):
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return date.timestamp()
+    return float(date)
+
+
+def make_grid(start, end, step=1.0):
+    """
+    The grid times (float64 seconds since epoch) from start (included) to end (excluded),
+    at multiples of step since the epoch.
+    """
+    first = np.ceil(to_seconds(start) / step) * step
+    return np.arange(first, to_seconds(end), step, dtype=np.float64)
+
+
+def readings(data, source, cols):
+    """
+    Reduces the rows of data (dict of arrays, with "time" in epoch milliseconds) to the readings of source:
+    returns (times in seconds, dict col -> values), sorted by time, each reading once.
+
+    The reading time is the col <source>_time. Rows without it (logged before it existed) count as
+    readings at the row time.
+    """
+    row_times = data["time"] / 1000.0
+    times = data.get(source + "_time")
+    if times is None:
+        times = row_times
+    else:
+        times = np.where(np.isnan(times), row_times, times)
+    # Rows repeat a reading until the next one arrives: keep the first row of each
+    keep = np.empty(len(times), dtype=bool)
+    keep[:1] = True
+    np.not_equal(times[1:], times[:-1], out=keep[1:])
+    times = times[keep]
+    values = {col:np.asarray(data[col], dtype=np.float64)[keep] for col in cols}
+    if len(times) > 1 and np.any(times[1:] <= times[:-1]): # Out of order, e.g. rows logged late
+        (times, index) = np.unique(times, return_index=True)
+        values = {col:value[index] for (col, value) in values.items()}
+    return (times, values)
+
+
+def last_index(grid, times):
+    """
+    For each grid time, the index of the last of the (sorted) times at or before it, -1 if none.
+    For a regular grid (as from make_grid()), each time is put in its grid step instead of searching,
+    which is O(len(grid) + len(times)).
+    """
+    m = len(grid)
+    step = grid[1] - grid[0] if m > 1 else 0.0
+    if step <= 0 or grid[-1] != grid[0] + step * (m - 1):
+        return np.searchsorted(times, grid, side="right") - 1
+    # k: the first grid index at or after each time, corrected for rounding
+    k = np.ceil((times - grid[0]) / step)
+    np.clip(k, 0, m, out=k)
+    k = k.astype(np.int64)
+    k -= (k > 0) & (np.take(grid, np.maximum(k - 1, 0)) >= times)
+    k += (k < m) & (np.take(grid, np.minimum(k, m - 1)) < times)
+    counts = np.bincount(k, minlength=m + 1)[:m]
+    return np.cumsum(counts) - 1
+
+
+class AsOf:
+    """
+    The lookup of the grid times in the (sorted) times of one series, see methods:
+    computed once, and applied to each array of values of that series.
+    """
+
+    def __init__(self, grid, times, tolerance, method="previous"):
+        if method not in methods:
+            raise ValueError(f"Unknown method {method}, choose from {methods}")
+        (self.grid, self.times, self.tolerance, self.method) = (grid, times, tolerance, method)
+        n = len(times)
+        m = len(grid)
+        if n == 0:
+            self.a = None
+            return
+        # i: the last reading at or before each grid time, j = i + 1 the first one after it.
+        # The grid is sorted, so the grid times before the first reading (i = -1) are a prefix,
+        # the ones at or after the last reading (j = n) a suffix.
+        i = last_index(grid, times)
+        before = np.searchsorted(i, 0) # Grid times before the first reading
+        after = np.searchsorted(i, n - 1) # From here, no reading after
+        ic = np.maximum(i, 0)
+        jc = np.minimum(i + 1, n - 1)
+        age = grid - np.take(times, ic)
+        age[:before] = np.inf
+        ahead = np.take(times, jc)
+        ahead -= grid
+        ahead[after:] = np.inf
+
+        # For each grid time, the reading(s) it takes its value from: a (and b, with weight for "linear"),
+        # and the grid positions without any reading within tolerance
+        self.weight = None
+        if method == "previous":
+            self.a = ic
+            self.missing = np.flatnonzero(~(age <= tolerance))
+        elif method == "nearest":
+            self.a = np.where(ahead < age, jc, ic)
+            self.missing = np.flatnonzero(~(np.minimum(age, ahead) <= tolerance))
+        else:
+            self.a = ic
+            self.b = jc
+            ok = age <= tolerance
+            ok &= ahead <= tolerance
+            ok |= age == 0.0
+            self.missing = np.flatnonzero(~ok)
+            with np.errstate(invalid="ignore"): # inf / inf where there is no reading around, missing anyway
+                self.weight = age / (age + ahead) # 0 for exact times
+
+    def __call__(self, values):
+        """
+        Aligns values (one per time, nan for missing ones: the lookup then gets redone without them).
+        """
+        valid = ~np.isnan(values)
+        if not np.all(valid):
+            return AsOf(self.grid, self.times[valid], self.tolerance, self.method)(values[valid])
+        if self.a is None:
+            return np.full(len(self.grid), np.nan)
+        result = np.take(values, self.a)
+        if self.weight is not None:
+            delta = np.take(values, self.b)
+            delta -= result
+            delta *= self.weight
+            result += delta
+        result[self.missing] = np.nan
+        return result
+
+
+def asof(grid, times, values, tolerance, method="previous"):
+    """
+    Aligns one series (times sorted, values with nan for missing ones) to the grid, see methods.
+    Returns a float64 array of the length of grid.
+    """
+    return AsOf(grid, times, tolerance, method)(values)
+
+
+def align(data, grid, cols=None, method="linear", tolerance=None):
+    """
+    Aligns the cols (default: all, except the <source>_time ones) of data (dict of arrays, see load_db())
+    to the grid, returns a dict with "time" (the grid) and the aligned cols.
+
+    tolerance is in seconds, a dict source -> seconds, or None for the defaults (tolerances).
+    Cols in step_cols use "previous" instead of "linear".
+    """
+    if cols is None:
+        cols = [col for col in data if col != "time" and not col.endswith("_time")]
+    by_source = {}
+    for col in cols:
+        by_source.setdefault(source_of(col), []).append(col)
+
+    aligned = {"time":grid}
+    for (source, source_cols) in by_source.items():
+        source_tolerance = tolerance
+        if tolerance is None or isinstance(tolerance, dict):
+            source_tolerance = (tolerance or tolerances).get(source, tolerances.get(source, 30.0))
+        (times, values) = readings(data, source, source_cols)
+        lookups = {} # method -> AsOf, shared by the cols of the source
+        for col in source_cols:
+            col_method = "previous" if (method == "linear" and col in step_cols) else method
+            if col_method not in lookups:
+                lookups[col_method] = AsOf(grid, times, source_tolerance, col_method)
+            aligned[col] = lookups[col_method](values[col])
+    return aligned
+
+
+def derive(aligned):
+    """
+    Quantities combining sources, from aligned series (in W):
+    - pconsume: household consumption = PV generation (Tripower) + grid purchase - grid supply (HomeManager)
+    - pselfconsume: PV power consumed in the household
+    - pheatpump: electrical power of the heat pump (open3e, in kW) in W, and its share of the consumption
+    """
+    pgenerate = aligned["SMATripower_pgenerate"]
+    psupply = aligned["SMAHomeManager_psupply"]
+    ppurchase = aligned["SMAHomeManager_ppurchase"]
+    derived = {"time":aligned["time"]}
+    derived["pconsume"] = pgenerate + ppurchase - psupply
+    derived["pselfconsume"] = np.clip(pgenerate - psupply, 0.0, None)
+    heatpump = aligned.get("VitocalOpen3E_CurrentElectricalPowerConsumptionSystem")
+    if heatpump is not None:
+        derived["pheatpump"] = 1000.0 * heatpump
+        with np.errstate(divide="ignore", invalid="ignore"):
+            derived["heatpump_share"] = np.where(derived["pconsume"] > 0, derived["pheatpump"] / derived["pconsume"], np.nan)
+    return derived
+
+
+def load_db(path, start, end, name="pvpi", cols=None):
+    """
+    Reads the rows from start to end (datetimes or seconds since epoch) from the logger db (read-only),
+    returns a dict with "time" (int64 epoch milliseconds) and the cols (float64, nan for NULL).
+    """
+    con = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        cur = con.execute("SELECT {} FROM {} WHERE time >= ? AND time < ? ORDER BY time".format(
+                          "*" if cols is None else ", ".join(["time"] + list(cols)), name),
+                          (int(1000 * to_seconds(start)), int(1000 * to_seconds(end))))
+        names = [d[0] for d in cur.description]
+        rows = cur.fetchall()
+    finally:
+        con.close()
+    table = np.array(rows, dtype=np.float64).reshape(len(rows), len(names)) # None -> nan
+    data = {col:table[:, k] for (k, col) in enumerate(names)}
+    data["time"] = data["time"].astype(np.int64)
+    return data
+
+
+def load_columnar(workdir, start, end, name="pvpi", cols=None):
+    """
+    The same as load_db(), from the columnar archive (see pvpi_columnar).
+    """
+    import pvpi_columnar
+    def as_datetime(date):
+        return datetime.fromtimestamp(to_seconds(date), timezone.utc)
+    return pvpi_columnar.read(workdir, name, cols=cols, start=as_datetime(start), end=as_datetime(end))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aligns the logged sources and derives the household consumption")
+    parser.add_argument("db", help="Path to the logger db")
+    parser.add_argument("--hours", type=float, default=24.0, help="The last hours to align")
+    parser.add_argument("--step", type=float, default=1.0, help="Seconds between grid times")
+    parser.add_argument("--method", choices=methods, default="linear")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(hours=args.hours)
+    data = load_db(args.db, start, end)
+    grid = make_grid(start, end, args.step)
+    aligned = align(data, grid, method=args.method)
+    derived = derive(aligned)
+
+    print(f"{len(data['time'])} rows, {len(grid)} grid times")
+    for (col, values) in aligned.items():
+        if col != "time":
+            print(f"{col:70} {100.0 * np.mean(~np.isnan(values)):6.1f} % covered")
+    reported = aligned["SMATripower_pconsume"]
+    both = ~np.isnan(reported) & ~np.isnan(derived["pconsume"])
+    if np.any(both):
+        difference = derived["pconsume"][both] - reported[both]
+        print(f"Household consumption: mean {np.mean(derived['pconsume'][both]):.0f} W derived, "
+              f"{np.mean(reported[both]):.0f} W reported by the Tripower, "
+              f"mean absolute difference {np.mean(np.abs(difference)):.0f} W")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Writing and reading of the daily archive files exported by mqtt-logger.py.
+
+Each day is one tab-separated csv file, optionally compressed:
+    <export_workdir>/<name>/<year>/<YYYY-MM-DD>.csv[.gz|.xz|.zst]
+next to a small json sidecar manifest <file>.json with the row count, time range, columns and a checksum,
+so that downstream tools can skip files without opening them.
+
+Files are written to <file>.part and renamed when complete, so a file without .part is always complete.
+
+zstd needs the optional zstandard package.
+"""
+
+import os
+import io
+import csv
+import gzip
+import lzma
+import json
+import hashlib
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Compression name -> file extension (after .csv)
+compressions = {"none":"", "gzip":".gz", "xz":".xz", "zstd":".zst"}
+
+
+def archive_dir(workdir, name, date):
+    return os.path.join(workdir, name, date.strftime('%Y'))
+
+def archive_path(workdir, name, date, compression="none"):
+    """Path of the archive file of the day of the given datetime"""
+    return os.path.join(archive_dir(workdir, name, date), date.strftime('%Y-%m-%d') + ".csv" + compressions[compression])
+
+def manifest_path(path):
+    return path + ".json"
+
+def find_archive(workdir, name, date):
+    """
+    Returns the path of the complete archive file of that day (in any compression), or None.
+    """
+    for ext in compressions.values():
+        path = os.path.join(archive_dir(workdir, name, date), date.strftime('%Y-%m-%d') + ".csv" + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def remove_other_archives(workdir, name, date, path):
+    """
+    Removes the archive files of that day (with their manifests) in other compressions than the file path.
+    """
+    for ext in compressions.values():
+        other = os.path.join(archive_dir(workdir, name, date), date.strftime('%Y-%m-%d') + ".csv" + ext)
+        if other != path and os.path.exists(other):
+            os.remove(other)
+            if os.path.exists(manifest_path(other)):
+                os.remove(manifest_path(other))
+            logger.info(f"Removed {other}, replaced by {path}")
+
+def list_archives(workdir, name):
+    """
+    Returns a sorted list of (date string YYYY-MM-DD, path) of all complete archive files.
+    If a day exists in several compressions, only one is listed.
+    """
+    found = {}
+    basedir = os.path.join(workdir, name)
+    if not os.path.isdir(basedir):
+        return []
+    for yeardir in sorted(os.listdir(basedir)):
+        if not os.path.isdir(os.path.join(basedir, yeardir)):
+            continue
+        for filename in sorted(os.listdir(os.path.join(basedir, yeardir))):
+            for ext in compressions.values():
+                if filename.endswith(".csv" + ext) and len(filename) == len("YYYY-MM-DD.csv" + ext):
+                    found.setdefault(filename[:10], os.path.join(basedir, yeardir, filename))
+    return sorted(found.items())
+
+
+class _HashingWriter(io.RawIOBase):
+    """
+    Passes the bytes to the file f, computing their sha256 and count on the way.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.n_bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        self.n_bytes += len(b)
+        return self.f.write(b)
+
+
+def _compressor(raw, compression):
+    """Binary stream compressing into raw, closing it does not close raw."""
+    if compression == "none":
+        return io.BufferedWriter(raw)
+    elif compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb", mtime=0)
+    elif compression == "xz":
+        return lzma.LZMAFile(raw, mode="wb")
+    elif compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    raise ValueError(f"Unknown compression {compression}, choose from {list(compressions.keys())}")
+
+
+def write_csv(path, header, cursor, compression="none", chunk_size=1000):
+    """
+    Streams all rows of the sqlite cursor (or any object with fetchmany()) into the archive file path,
+    chunk_size rows at a time, and writes the manifest.
+    The first column is expected to be the datetime.
+
+    Returns the manifest (a dict).
+    """
+    part_path = path + ".part"
+    n_rows = 0
+    first = None
+    last = None
+    with open(part_path, "wb") as f:
+        raw = _HashingWriter(f)
+        stream = io.TextIOWrapper(_compressor(raw, compression), encoding="UTF-8", newline="")
+        csv_writer = csv.writer(stream, delimiter="\t")
+        csv_writer.writerow(header)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            if first is None:
+                first = rows[0][0]
+            last = rows[-1][0]
+            csv_writer.writerows(rows)
+            n_rows += len(rows)
+        stream.close() # Also closes the compressor, not raw
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(part_path, path) # The file is now complete
+
+    manifest = {"file":os.path.basename(path),
+                "rows":n_rows,
+                "first":first,
+                "last":last,
+                "columns":list(header),
+                "compression":compression,
+                "bytes":raw.n_bytes,
+                "sha256":raw.sha256.hexdigest(),
+                "created":datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                }
+    write_manifest(path, manifest)
+    return manifest
+
+
+def write_manifest(path, manifest):
+    tmp_path = manifest_path(path) + ".part"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path(path))
+
+def read_manifest(path):
+    """Returns the manifest of the archive file path, or None if there is none."""
+    try:
+        with open(manifest_path(path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def open_csv(path):
+    """
+    Opens an archive file (any compression, guessed from the extension) as text, for csv.reader(f, delimiter="\\t").
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="UTF-8", newline="")
+    elif path.endswith(".xz"):
+        return lzma.open(path, "rt", encoding="UTF-8", newline="")
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Reading zstd files needs the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True),
+                                encoding="UTF-8", newline="")
+    return open(path, "r", encoding="UTF-8", newline="")
+
+
+def read_rows(path, cols):
+    """
+    Yields (epoch milliseconds, list of values in the order of cols) for each row of an archive file.
+    Values are floats, nan if empty or if the column is not in the file.
+    """
+    nan = float("nan")
+    with open_csv(path) as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        index = [header.index(col) if col in header else None for col in cols]
+        for row in reader:
+            date = datetime.fromisoformat(row[0]).replace(tzinfo=timezone.utc)
+            values = [nan if (i is None or row[i] == "") else float(row[i]) for i in index]
+            yield (int(date.timestamp() * 1000), values)
+
+
+def read_day(path, cols, converters):
+    """
+    Returns the list of rows [epoch milliseconds, values in the order of cols...] of the archive file of one day,
+    sorted by time. If several rows have the same time (the datetimes have a resolution of 1 s),
+    only the last one is kept, and rows of other days are skipped.
+    converters are the functions (one per col) turning the text of a value into the value, empty texts and
+    columns that are not in the file give None.
+    """
+    date = datetime.strptime(os.path.basename(path)[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    datestr = date.strftime("%Y-%m-%d")
+    start_ms = int(date.timestamp() * 1000)
+    by_time = {}
+    n_other = 0
+    with open_csv(path) as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        index = [header.index(col) if col in header else None for col in cols]
+        parsers = list(zip(index, converters))
+        for row in reader:
+            text = row[0]
+            if not text.startswith(datestr):
+                n_other += 1
+                continue
+            # Much faster than datetime.fromisoformat(), the format is "%Y-%m-%d %H:%M:%S"
+            time_ms = start_ms + 1000 * (3600 * int(text[11:13]) + 60 * int(text[14:16]) + int(text[17:19]))
+            by_time[time_ms] = [time_ms] + [None if (i is None or row[i] == "") else converter(row[i])
+                                            for (i, converter) in parsers]
+    if n_other > 0:
+        logger.warning(f"Skipped {n_other} rows of other days than {datestr} in {path}")
+    return [by_time[time_ms] for time_ms in sorted(by_time)]
+
+
+def remove_partial(workdir, name):
+    """
+    Removes leftover .part files from interrupted exports, returns their number.
+    """
+    n = 0
+    basedir = os.path.join(workdir, name)
+    if not os.path.isdir(basedir):
+        return 0
+    for (dirpath, dirnames, filenames) in os.walk(basedir):
+        for filename in filenames:
+            if filename.endswith(".part"):
+                os.remove(os.path.join(dirpath, filename))
+                n += 1
+    if n > 0:
+        logger.info(f"Removed {n} partial files from interrupted exports in {basedir}")
+    return n
@@ -0,0 +1,219 @@
+"""
+Columnar, memory-mappable archive of the logged data, as an alternative to the daily csv files.
+
+Each day is a directory
+    <workdir>/<name>-columnar/<year>/<YYYY-MM-DD>/
+containing one .npy file per column: time.npy (int64, milliseconds since epoch, UTC) and <col>.npy (float64,
+nan where no value was logged), plus a meta.json with the row count, the columns and the time range.
+The .npy files get memory-mapped when reading, so unused columns are never loaded.
+
+Usage as a script, to back-fill the columnar archive from the existing csv history:
+    python pvpi_columnar.py backfill /home/mtewes/data/ --name pvpi
+
+Needs numpy.
+"""
+
+import os
+import sys
+import csv
+import json
+import shutil
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+
+import pvpi_archive
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def columnar_dir(workdir, name):
+    return os.path.join(workdir, name + "-columnar")
+
+def day_dir(workdir, name, date):
+    return os.path.join(columnar_dir(workdir, name), date.strftime('%Y'), date.strftime('%Y-%m-%d'))
+
+def list_days(workdir, name):
+    """
+    Returns a sorted list of (date string YYYY-MM-DD, directory) of all complete days.
+    """
+    found = []
+    basedir = columnar_dir(workdir, name)
+    if not os.path.isdir(basedir):
+        return []
+    for yeardir in sorted(os.listdir(basedir)):
+        if not os.path.isdir(os.path.join(basedir, yeardir)):
+            continue
+        for daydir in sorted(os.listdir(os.path.join(basedir, yeardir))):
+            path = os.path.join(basedir, yeardir, daydir)
+            if len(daydir) == 10 and os.path.exists(os.path.join(path, "meta.json")):
+                found.append((daydir, path))
+    return found
+
+
+def write_day(path, times, columns):
+    """
+    Writes one day.
+    times is an array of epoch milliseconds, columns a dict of column name -> array of values (same length).
+    The directory is written as path.part and renamed when complete.
+    """
+    part_path = path + ".part"
+    if os.path.exists(part_path):
+        shutil.rmtree(part_path)
+    os.makedirs(part_path)
+
+    times = np.asarray(times, dtype=np.int64)
+    np.save(os.path.join(part_path, "time.npy"), times)
+    for (col, values) in columns.items():
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != len(times):
+            raise ValueError(f"Column {col} has {len(values)} values for {len(times)} times")
+        np.save(os.path.join(part_path, col + ".npy"), values)
+
+    meta = {"rows":len(times),
+            "columns":list(columns.keys()),
+            "first":int(times[0]) if len(times) > 0 else None,
+            "last":int(times[-1]) if len(times) > 0 else None,
+            }
+    with open(os.path.join(part_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(part_path, path)
+    return meta
+
+
+def write_day_from_cursor(path, cursor, chunk_size=1000):
+    """
+    Writes one day from an sqlite cursor selecting time (epoch ms) followed by the value columns.
+    """
+    names = [d[0] for d in cursor.description]
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        # None (sqlite NULL) becomes nan
+        chunks.append(np.array(rows, dtype=np.float64))
+    if len(chunks) > 0:
+        data = np.concatenate(chunks)
+    else:
+        data = np.empty((0, len(names)))
+    return write_day(path, data[:, 0].astype(np.int64), {col:data[:, i] for (i, col) in enumerate(names) if i > 0})
+
+
+def parse_csv(path):
+    """
+    Reads a daily csv archive file (any compression) into (times, columns), as needed by write_day().
+    """
+    with pvpi_archive.open_csv(path) as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        rows = list(reader)
+    if header[0] != "datetime":
+        raise ValueError(f"Unexpected first column {header[0]} in {path}")
+
+    times = np.array([row[0] for row in rows], dtype="datetime64[ms]").astype(np.int64)
+    columns = {}
+    for (i, col) in enumerate(header):
+        if i == 0:
+            continue
+        columns[col] = np.array([row[i] if row[i] != "" else "nan" for row in rows], dtype=np.float64)
+    return (times, columns)
+
+
+def backfill(workdir, name, force=False):
+    """
+    Converts all daily csv archive files that have no columnar version yet (or all of them, if force).
+    Returns the number of converted days.
+    """
+    n = 0
+    for (datestr, path) in pvpi_archive.list_archives(workdir, name):
+        date = datetime.strptime(datestr, "%Y-%m-%d")
+        target = day_dir(workdir, name, date)
+        if os.path.exists(os.path.join(target, "meta.json")) and not force:
+            continue
+        (times, columns) = parse_csv(path)
+        meta = write_day(target, times, columns)
+        logger.info(f"Converted {path} ({meta['rows']} rows)")
+        n += 1
+    return n
+
+
+def _to_ms(date):
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def read(workdir, name, cols=None, start=None, end=None):
+    """
+    Returns a dict with "time" (int64 epoch milliseconds) and the requested cols (float64) as NumPy arrays,
+    for start <= time < end (datetimes, naive ones are taken as UTC, None means unbounded).
+
+    Only the days in the range and only the requested columns are touched (memory-mapped).
+    Columns missing in some day are filled with nan.
+    If cols is None, all columns of the first day in the range are returned.
+    If the range covers only one day, the arrays are read-only views into the memory-mapped files.
+    """
+    start_ms = _to_ms(start)
+    end_ms = _to_ms(end)
+    start_day = None if start is None else datetime.fromtimestamp(start_ms // 1000, timezone.utc).strftime("%Y-%m-%d")
+    end_day = None if end is None else datetime.fromtimestamp((end_ms - 1) // 1000, timezone.utc).strftime("%Y-%m-%d")
+
+    parts = []
+    for (datestr, path) in list_days(workdir, name):
+        if (start_day is not None and datestr < start_day) or (end_day is not None and datestr > end_day):
+            continue
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if cols is None:
+            cols = meta["columns"]
+
+        times = np.load(os.path.join(path, "time.npy"), mmap_mode="r")
+        i0 = 0 if start_ms is None else np.searchsorted(times, start_ms, side="left")
+        i1 = len(times) if end_ms is None else np.searchsorted(times, end_ms, side="left")
+        if i1 <= i0:
+            continue
+        part = {"time":times[i0:i1]}
+        for col in cols:
+            if col in meta["columns"]:
+                part[col] = np.load(os.path.join(path, col + ".npy"), mmap_mode="r")[i0:i1]
+            else:
+                part[col] = np.full(i1 - i0, np.nan)
+        parts.append(part)
+
+    if cols is None:
+        cols = []
+    if len(parts) == 0:
+        result = {"time":np.empty(0, dtype=np.int64)}
+        result.update({col:np.empty(0) for col in cols})
+        return result
+    if len(parts) == 1:
+        return parts[0]
+    return {key:np.concatenate([part[key] for part in parts]) for key in ["time"] + list(cols)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar archive of the pvpi logger")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="Convert the daily csv files into the columnar format")
+    backfill_parser.add_argument("workdir", help="export_workdir of the logger")
+    backfill_parser.add_argument("--name", default="pvpi")
+    backfill_parser.add_argument("--force", action="store_true", help="Also convert days that already exist")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "backfill":
+        n = backfill(args.workdir, args.name, force=args.force)
+        print(f"Converted {n} days.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Minimal local stand-in for the Shelly relay, to test the SG-Ready control (pvpi-sgready.py) without hardware.
+
+Implements the Gen1 style relay API used by pvpi-sgready.py:
+    GET /relay/0             -> {"ison": false, ...}
+    GET /relay/0?turn=on|off -> switches, same answer
+with keep-alive, and records the time (time.monotonic()) of each switching.
+
+As a script:
+    python pvpi_fakeshelly.py --port 8081
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FakeShelly:
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0):
+        """
+        port 0 picks a free port, see self.url. delay (seconds) is added to each answer, to mimic a slow relay.
+        """
+        self.ison = False
+        self.delay = delay
+        self.switches = [] # (time.monotonic(), ison)
+        self.n_requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.thread = None
+
+    def _handler(self):
+        shelly = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, as the real one
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/relay/0":
+                    self.send_error(404)
+                    return
+                turn = parse_qs(url.query).get("turn", [None])[0]
+                if shelly.delay > 0:
+                    time.sleep(shelly.delay)
+                with shelly.lock:
+                    shelly.n_requests += 1
+                    if turn in ("on", "off"):
+                        shelly.ison = (turn == "on")
+                        shelly.switches.append((time.monotonic(), shelly.ison))
+                    elif turn is not None:
+                        self.send_error(400)
+                        return
+                    body = json.dumps({"ison":shelly.ison, "has_timer":False, "source":"http"}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Fake Shelly listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Shelly relay, for testing pvpi-sgready.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds added to each answer")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    shelly = FakeShelly(args.host, args.port, args.delay)
+    print(f"Fake Shelly on {shelly.url}/relay/0")
+    try:
+        shelly.server.serve_forever()
+    except KeyboardInterrupt:
+        print("Bye!")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Lightweight instrumentation: call counts and latency histograms of some functions, plus gauges,
+published every minute as json to the MQTT topic tree pvpi/metrics/<app>/...
+
+    import pvpi_metrics
+
+    @pvpi_metrics.timed("on_message")
+    def on_message(...):
+        ...
+
+    pvpi_metrics.start_publisher(mqttc, "logger", gauges={"queue":writer.stats})
+
+Topics (retained = False):
+    pvpi/metrics/<app>/timers    {name: {"n", "mean_ms", "p50_ms", "p99_ms", "max_ms"}} over the last minute
+    pvpi/metrics/<app>/gauges    {name: value returned by the gauge function}
+    pvpi/metrics/<app>/process   {"rss_kb", "cpu_percent", "threads"}
+
+Set the environment variable PVPI_METRICS=0 to switch everything off: timed() then returns the functions
+undecorated (this is decided at import time), and start_publisher() does nothing.
+The histograms are not locked, under concurrent calls a few counts may get lost.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+import functools
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+enabled = os.environ.get("PVPI_METRICS", "1").lower() not in ("0", "false", "no", "off")
+
+# Upper bounds of the histogram buckets, in seconds: 10 us to 100 s, about 4 per decade
+_BOUNDS = [m * 10.0 ** e for e in range(-5, 2) for m in (1.0, 1.8, 3.2, 5.6)] + [100.0]
+
+
+class Histogram:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(_BOUNDS, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q, counts, n):
+        """Upper bound of the bucket containing the quantile q"""
+        target = q * n
+        cumulative = 0
+        for (i, count) in enumerate(counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                return _BOUNDS[i] if i < len(_BOUNDS) else float("inf")
+        return None
+
+    def summary(self, reset=True):
+        (counts, n, total, maximum) = (self.counts, self.n, self.total, self.max)
+        if reset:
+            self.reset()
+        if n == 0:
+            return {"n":0}
+        return {"n":n,
+                "mean_ms":round(1000.0 * total / n, 4),
+                "p50_ms":round(1000.0 * min(self.quantile(0.5, counts, n), maximum), 4),
+                "p99_ms":round(1000.0 * min(self.quantile(0.99, counts, n), maximum), 4),
+                "max_ms":round(1000.0 * maximum, 4),
+                }
+
+
+timers = {} # name -> Histogram
+
+
+def timed(name):
+    """
+    Decorator recording the number of calls and the duration of the function under name.
+    """
+    if not enabled:
+        return lambda function: function
+    histogram = timers.setdefault(name, Histogram())
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.add(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def timer_summaries(reset=True):
+    return {name:histogram.summary(reset=reset) for (name, histogram) in timers.items()}
+
+
+def process_stats(previous=None):
+    """
+    Returns (stats dict, state to pass as previous next time, for the CPU percentage since then).
+    """
+    rss_kb = None
+    threads = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError: # Not on Linux
+        pass
+    times = os.times()
+    state = (time.monotonic(), times.user + times.system)
+    cpu_percent = None
+    if previous is not None and state[0] > previous[0]:
+        cpu_percent = round(100.0 * (state[1] - previous[1]) / (state[0] - previous[0]), 2)
+    return ({"rss_kb":rss_kb, "cpu_percent":cpu_percent, "threads":threads}, state)
+
+
+class Publisher:
+    """
+    Thread publishing the metrics every interval seconds (aligned to the wall clock).
+    """
+
+    def __init__(self, mqttc, app, gauges=None, interval=60.0):
+        self.mqttc = mqttc
+        self.prefix = f"pvpi/metrics/{app}/"
+        self.gauges = gauges if gauges is not None else {}
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.process_state = process_stats()[1]
+        self.thread = threading.Thread(target=self.run, name="pvpi_metrics", daemon=True)
+
+    def collect(self):
+        gauges = {}
+        for (name, function) in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception as e:
+                gauges[name] = None
+                logger.warning(f"Metrics gauge {name} failed: {e}")
+        (process, self.process_state) = process_stats(self.process_state)
+        return {"timers":timer_summaries(), "gauges":gauges, "process":process}
+
+    def publish(self):
+        for (section, values) in self.collect().items():
+            self.mqttc.publish(self.prefix + section, json.dumps(values, separators=(",", ":")), qos=0)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval - time.time() % self.interval):
+            try:
+                self.publish()
+            except Exception:
+                logger.exception("Could not publish the metrics")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def start_publisher(mqttc, app, gauges=None, interval=60.0):
+    """
+    Starts publishing the metrics with the paho client mqttc, returns the Publisher (or None if disabled).
+    gauges is a dict name -> function returning a json-serializable value.
+    """
+    if not enabled:
+        return None
+    return Publisher(mqttc, app, gauges, interval).start()
@@ -0,0 +1,325 @@
+"""
+Read-only queries of the logger db (see LogDB in mqtt-logger.py), for the plots and the display,
+from other processes or threads than the logger, while it keeps writing.
+
+    service = pvpi_query.QueryService("/home/mtewes/data/pvpi.db")
+    data = service.query(["SMATripower_pgenerate", "SMAHomeManager_psupply"], start, end, step=300)
+    # {"time":(epoch milliseconds, ...), "SMATripower_pgenerate":(...), "SMAHomeManager_psupply":(...)}
+    values = service.latest(["VitocalOpen3E_ThermalPower"])
+    service.close()
+
+- Each query is one single statement (a consistent snapshot) on a read-only connection from a pool,
+  a new connection gets opened when all are in use. With the WAL journal of the logger, readers never block
+  the writer nor each other. A reader only keeps the WAL from being checkpointed while its query runs.
+- Only the partitions of the days in the time range are read, by primary key range.
+  Of sparse partitions, only the requested cols are rebuilt (not all cols of the dense view).
+- With step (seconds), the rows get downsampled in SQL: avg, min or max per bucket of step seconds (aligned to the epoch).
+  If step is a multiple of a rollup level and all cols have that stat in the rollups (counter cols do not),
+  the rollup table gets read instead, which also covers the days already dropped from the partitions.
+  The range then starts at the beginning of its first rollup bucket.
+- Results are kept in an LRU cache, which gets emptied as soon as anything was written to the db
+  (PRAGMA data_version). The values are tuples, also the cached ones are shared between the callers.
+"""
+
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+import contextlib
+import collections
+from datetime import datetime, timedelta, timezone
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+day_ms = 24 * 3600 * 1000
+
+# Downsampling function -> (SQL over the rows, SQL over the rollup stats of col c)
+aggregates = {"avg":("avg({c})", "sum({c}_mean * {c}_n) / sum({c}_n)"),
+              "min":("min({c})", "min({c}_min)"),
+              "max":("max({c})", "max({c}_max)"),
+              }
+
+
+def to_ms(date):
+    """Epoch milliseconds of a datetime (naive ones are taken as UTC), None stays None"""
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def union_all(selects):
+    """The UNION ALL of the selects, nested if needed (sqlite allows at most 500 terms in one compound SELECT)"""
+    while len(selects) > 500:
+        selects = ["SELECT * FROM ({})".format(" UNION ALL ".join(selects[i:i + 500])) for i in range(0, len(selects), 500)]
+    return " UNION ALL ".join(selects)
+
+
+class Schema:
+    """
+    The partitions and rollup tables found in the db, with their cols.
+    """
+
+    def __init__(self, con, name):
+        self.version = con.execute("PRAGMA schema_version").fetchone()[0]
+        self.partitions = {} # day number (days since epoch) -> (table, sparse, list of cols)
+        self.rollups = {} # level (seconds) -> (table, set of cols)
+        for (table,) in con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name GLOB ?",
+                                    (name + "_*",)).fetchall():
+            suffix = table[len(name) + 1:]
+            cols = [row[1] for row in con.execute("PRAGMA table_info({})".format(table))]
+            if len(suffix) == 8 and suffix.isdigit():
+                self.partitions[self.day(suffix)] = (table, False, cols[1:])
+            elif suffix.startswith("sparse_") and len(suffix) == 15 and suffix[7:].isdigit():
+                self.partitions[self.day(suffix[7:])] = (table, True, cols[2:]) # after time, written
+            elif suffix.startswith("rollup_") and suffix[7:].isdigit():
+                self.rollups[int(suffix[7:])] = (table, set(cols[1:]))
+
+    @staticmethod
+    def day(ymd):
+        return to_ms(datetime.strptime(ymd, "%Y%m%d")) // day_ms
+
+    def days(self, start_ms, end_ms):
+        """The days of the partitions overlapping start_ms <= time < end_ms (None: unbounded)"""
+        return [day for day in sorted(self.partitions)
+                if (start_ms is None or day >= start_ms // day_ms) and (end_ms is None or day <= (end_ms - 1) // day_ms)]
+
+    def rollup_level(self, step, cols, agg):
+        """The longest rollup level that step is a multiple of and that has the stats for agg of all cols, or None"""
+        stat = {"avg":"mean", "min":"min", "max":"max"}[agg]
+        levels = [level for (level, (table, columns)) in self.rollups.items()
+                  if step % level == 0 and all("{}_{}".format(col, stat) in columns for col in cols)]
+        return max(levels) if levels else None
+
+
+def partition_select(table, sparse, table_cols, cols):
+    """
+    SELECT of time and the cols of one partition, for the time range given by the two parameters start, end.
+    Cols not in the partition are NULL.
+    """
+    if not sparse:
+        values = ", ".join([col if col in table_cols else "NULL AS {}".format(col) for col in cols])
+        return "SELECT time, {} FROM {} WHERE time >= ? AND time < ?".format(values, table)
+    # As the view of LogDB.create_sparse_view(), for these cols only. The running max starts at the beginning
+    # of the day (whose first row has all values), hence the range is applied after it.
+    present = [col for col in cols if col in table_cols]
+    times = ", ".join(["max(CASE WHEN written & {} THEN time END) OVER w AS t_{}".format(1 << table_cols.index(col), col)
+                       for col in present])
+    values = ", ".join(["CASE WHEN t_{0} = time THEN {0} ELSE (SELECT {0} FROM {1} AS h WHERE h.time = t_{0}) END AS {0}".format(
+                        col, table) if col in present else "NULL AS {}".format(col) for col in cols])
+    inner = "SELECT time, {}{}{} FROM {} WHERE time < ? WINDOW w AS (ORDER BY time)".format(
+            ", ".join(present), ", " if present else "", times or "NULL", table)
+    return "SELECT time, {} FROM ({}) WHERE time >= ?".format(values, inner)
+
+
+class QueryService:
+
+    def __init__(self, path, name="pvpi", pool_size=4, cache_size=64, timeout=5.0):
+        """
+        path is the db of the logger, name its table name (LogDB.name).
+        pool_size is the number of idle connections kept open, cache_size the number of results kept in the cache.
+        timeout (seconds) is how long a query waits if the db is locked (only during a WAL recovery or an import).
+        """
+        self.path = path
+        self.name = name
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.timeout = timeout
+
+        self.pool = [] # idle connections
+        self.pool_lock = threading.Lock()
+        self.n_connections = 0
+
+        # PRAGMA data_version is local to each connection, hence one connection is kept for it alone
+        self.version_con = self.connect()
+        self.version_lock = threading.Lock()
+        self.data_version = None
+
+        self.cache = collections.OrderedDict() # key -> result, the most recently used last
+        self.cache_lock = threading.Lock()
+        self.schema = None
+        self.n_hits = 0
+        self.n_misses = 0
+        self.query_seconds = 0.0
+
+    def connect(self):
+        # Autocommit (isolation_level=None): each statement is its own read transaction
+        con = sqlite3.connect("file:{}?mode=ro".format(self.path), uri=True, timeout=self.timeout,
+                              isolation_level=None, check_same_thread=False)
+        self.n_connections += 1
+        return con
+
+    @contextlib.contextmanager
+    def connection(self):
+        """A connection from the pool, or a new one if none is idle"""
+        with self.pool_lock:
+            con = self.pool.pop() if self.pool else None
+        if con is None:
+            con = self.connect()
+        try:
+            yield con
+        finally:
+            with self.pool_lock:
+                if len(self.pool) < self.pool_size:
+                    self.pool.append(con)
+                    con = None
+            if con is not None:
+                con.close()
+                self.n_connections -= 1
+
+    def check_version(self):
+        """
+        Empties the cache if something was written to the db since the last check, returns the current data version.
+        """
+        with self.version_lock:
+            version = self.version_con.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return version
+            self.data_version = version
+            schema_version = self.version_con.execute("PRAGMA schema_version").fetchone()[0]
+            if self.schema is None or self.schema.version != schema_version:
+                self.schema = Schema(self.version_con, self.name)
+            with self.cache_lock:
+                self.cache.clear()
+        return version
+
+    def cached(self, key, function):
+        """The cached result for key, or the result of function(schema, con), which then gets cached"""
+        version = self.check_version()
+        with self.cache_lock:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.n_hits += 1
+                return result
+            self.n_misses += 1
+            schema = self.schema
+        starttime = time.perf_counter()
+        with self.connection() as con:
+            result = function(schema, con)
+        self.query_seconds += time.perf_counter() - starttime
+        with self.cache_lock:
+            if self.data_version != version: # Another query saw a newer version meanwhile, this result might be older
+                return result
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def query(self, cols, start=None, end=None, step=None, agg="avg", rollups=True):
+        """
+        Returns a dict with "time" (epoch milliseconds) and the cols, as tuples of the values (None for NULL),
+        for start <= time < end (datetimes, naive ones are taken as UTC, None means unbounded).
+        With step (seconds), the rows are downsampled with agg ("avg", "min" or "max") into buckets of step seconds,
+        whose start is the time. rollups=False never reads the rollup tables.
+        """
+        if agg not in aggregates:
+            raise ValueError(f"Unknown agg {agg}, choose from {list(aggregates.keys())}")
+        cols = list(cols)
+        step_ms = None if step is None else int(1000 * step)
+        key = ("query", tuple(cols), to_ms(start), to_ms(end), step_ms, agg, rollups)
+        return self.cached(key, lambda schema, con: self.run_query(schema, con, cols, to_ms(start), to_ms(end),
+                                                                     step_ms, agg, rollups))
+
+    def run_query(self, schema, con, cols, start_ms, end_ms, step_ms, agg, rollups):
+        level = None
+        if step_ms is not None and rollups and step_ms % 1000 == 0:
+            level = schema.rollup_level(step_ms // 1000, cols, agg)
+        if level is not None:
+            (table, columns) = schema.rollups[level]
+            values = ", ".join(["{} AS {}".format(aggregates[agg][1].format(c=col), col) for col in cols])
+            bucket_start = None if start_ms is None else start_ms - start_ms % (level * 1000)
+            cmd = "SELECT bucket / {0} * {0} AS time, {1} FROM {2} WHERE bucket >= ? AND bucket < ? GROUP BY 1 ORDER BY 1".format(
+                  step_ms, values, table)
+            params = [bucket_start if bucket_start is not None else -2**62, end_ms if end_ms is not None else 2**62]
+        else:
+            selects = []
+            params = []
+            for day in schema.days(start_ms, end_ms):
+                (table, sparse, table_cols) = schema.partitions[day]
+                selects.append(partition_select(table, sparse, table_cols, cols))
+                # Clipped to the day: the parameters of the sparse select come in the order end, start
+                (lower, upper) = (max(day * day_ms, start_ms or 0), min((day + 1) * day_ms, end_ms or 2**62))
+                params.extend([upper, lower] if sparse else [lower, upper])
+            if len(selects) == 0:
+                return {col:() for col in ["time"] + cols}
+            cmd = union_all(selects)
+            if step_ms is None:
+                cmd = "SELECT * FROM ({}) ORDER BY time".format(cmd)
+            else:
+                values = ", ".join(["{} AS {}".format(aggregates[agg][0].format(c=col), col) for col in cols])
+                cmd = "SELECT time / {0} * {0} AS time, {1} FROM ({2}) GROUP BY 1 ORDER BY 1".format(step_ms, values, cmd)
+        rows = con.execute(cmd, params).fetchall()
+        if len(rows) == 0:
+            return {col:() for col in ["time"] + cols}
+        return dict(zip(["time"] + cols, zip(*rows)))
+
+    def latest(self, cols):
+        """
+        Returns a dict with the time of the last row ("time", epoch milliseconds) and the latest value of each col,
+        None if there is nothing logged.
+        """
+        cols = list(cols)
+        return self.cached(("latest", tuple(cols)), lambda schema, con: self.run_latest(schema, con, cols))
+
+    def run_latest(self, schema, con, cols):
+        if len(schema.partitions) == 0:
+            return {col:None for col in ["time"] + cols}
+        (table, sparse, table_cols) = schema.partitions[max(schema.partitions)]
+        if sparse:
+            values = ", ".join(["(SELECT {} FROM {} WHERE written & {} ORDER BY time DESC LIMIT 1)".format(
+                                col, table, 1 << table_cols.index(col)) if col in table_cols else "NULL" for col in cols])
+            cmd = "SELECT (SELECT max(time) FROM {}), {}".format(table, values)
+        else:
+            values = ", ".join([col if col in table_cols else "NULL" for col in cols])
+            cmd = "SELECT time, {} FROM {} ORDER BY time DESC LIMIT 1".format(values, table)
+        row = con.execute(cmd).fetchone()
+        if row is None:
+            return {col:None for col in ["time"] + cols}
+        return dict(zip(["time"] + cols, row))
+
+    def stats(self):
+        """Counters of the cache and the connections, e.g. for a pvpi_metrics gauge"""
+        return {"hits":self.n_hits,
+                "misses":self.n_misses,
+                "cached":len(self.cache),
+                "connections":self.n_connections,
+                "query_s":round(self.query_seconds, 3),
+                }
+
+    def close(self):
+        with self.pool_lock:
+            for con in self.pool:
+                con.close()
+            self.pool = []
+        self.version_con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries the logger db (read-only), prints the rows tab-separated")
+    parser.add_argument("db", help="Path to the logger db")
+    parser.add_argument("cols", nargs="+", help="The cols (db names, e.g. SMATripower_pgenerate)")
+    parser.add_argument("--hours", type=float, default=24.0, help="The last hours")
+    parser.add_argument("--step", type=float, default=None, help="Downsample to buckets of this many seconds")
+    parser.add_argument("--agg", choices=list(aggregates.keys()), default="avg")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = QueryService(args.db)
+    end = datetime.now(timezone.utc)
+    data = service.query(args.cols, end - timedelta(hours=args.hours), end, step=args.step, agg=args.agg)
+    print("\t".join(["datetime"] + args.cols))
+    for (i, time_ms) in enumerate(data["time"]):
+        date = datetime.fromtimestamp(time_ms / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        print("\t".join([date] + ["" if data[col][i] is None else str(data[col][i]) for col in args.cols]))
+    logger.info(f"{len(data['time'])} rows, {service.stats()}")
+    service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
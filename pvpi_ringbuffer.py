@@ -0,0 +1,180 @@
+"""
+Fixed-size ring buffer of the most recent logged rows, in shared memory, for live consumers
+(I2C display, checkplots, ...), so that they never have to touch the sqlite db on the SD card.
+
+The logger creates it and appends each row it logs:
+    ring = RingBuffer.create("pvpi", cols, capacity=8192)
+    ring.append(time_ms, row)
+
+Other processes attach to it by name and read:
+    ring = RingBuffer.attach("pvpi")
+    (times, values) = ring.read(seconds=3600, cols=["SMATripower_pgenerate"])
+
+Layout of the shared memory block:
+- header: 8 int64 (see the _H_ constants)
+- the column names, as json, in a fixed-size bytes area
+- time: int64[capacity], epoch milliseconds (UTC)
+- data: float64[ncols, capacity], i.e. each column is contiguous
+
+A sequence counter (odd while the writer is busy) lets readers detect and retry torn reads.
+There must be only one writer.
+
+Needs numpy.
+"""
+
+import json
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_MAGIC = 0x70767069 # "pvpi"
+_H_MAGIC = 0
+_H_CAPACITY = 1
+_H_NCOLS = 2
+_H_COUNT = 3 # Total number of rows appended so far
+_H_SEQ = 4 # Incremented before and after each append
+_HEADER_SIZE = 8 * 8
+_NAMES_SIZE = 8192
+
+
+def _shm_name(name):
+    return name + "_ring"
+
+
+class RingBuffer:
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((8,), dtype=np.int64, buffer=shm.buf, offset=0)
+        if self.header[_H_MAGIC] != _MAGIC:
+            raise RuntimeError(f"Shared memory {shm.name} is not a ring buffer")
+        self.capacity = int(self.header[_H_CAPACITY])
+        ncols = int(self.header[_H_NCOLS])
+
+        names = bytes(shm.buf[_HEADER_SIZE:_HEADER_SIZE + _NAMES_SIZE]).rstrip(b"\x00")
+        self.cols = json.loads(names.decode("UTF-8"))
+        self.index = {col:i for (i, col) in enumerate(self.cols)}
+
+        offset = _HEADER_SIZE + _NAMES_SIZE
+        self.times = np.ndarray((self.capacity,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += 8 * self.capacity
+        self.data = np.ndarray((ncols, self.capacity), dtype=np.float64, buffer=shm.buf, offset=offset)
+        self.n_skipped = 0 # Rows older than the newest one, not appended
+
+    @classmethod
+    def create(cls, name, cols, capacity=8192):
+        """
+        Creates the ring buffer (replacing a leftover one of the same name), to be used by the writer.
+        """
+        names = json.dumps(list(cols)).encode("UTF-8")
+        if len(names) > _NAMES_SIZE:
+            raise ValueError("Too many / too long column names for the ring buffer")
+        size = _HEADER_SIZE + _NAMES_SIZE + 8 * capacity * (1 + len(cols))
+        try:
+            shm = shared_memory.SharedMemory(name=_shm_name(name), create=True, size=size)
+        except FileExistsError: # From a previous run that did not close properly
+            old = shared_memory.SharedMemory(name=_shm_name(name))
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name=_shm_name(name), create=True, size=size)
+
+        header = np.ndarray((8,), dtype=np.int64, buffer=shm.buf, offset=0)
+        header[:] = 0
+        header[_H_CAPACITY] = capacity
+        header[_H_NCOLS] = len(cols)
+        shm.buf[_HEADER_SIZE:_HEADER_SIZE + len(names)] = names
+        header[_H_MAGIC] = _MAGIC
+        del header # No reference to shm.buf must be left when closing
+        ring = cls(shm, owner=True)
+        ring.data[:] = np.nan
+        logger.info(f"Created ring buffer {shm.name} for {capacity} rows of {len(cols)} cols ({size} bytes)")
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attaches to an existing ring buffer, to read from it.
+        """
+        shm = shared_memory.SharedMemory(name=_shm_name(name))
+        # Python registers the block also when only attaching, and would remove it when this process exits.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    @property
+    def count(self):
+        """Total number of rows appended so far, can be polled to see if there is something new."""
+        return int(self.header[_H_COUNT])
+
+    def append(self, time_ms, row):
+        """
+        Appends a row (values in the order of cols, None or nan if missing).
+        Rows older than the newest one (e.g. after the clock was set back) are skipped, read() needs the time order.
+        """
+        header = self.header
+        count = int(header[_H_COUNT])
+        if count > 0 and time_ms < self.times[(count - 1) % self.capacity]:
+            self.n_skipped += 1
+            if self.n_skipped % 100 == 1:
+                logger.warning(f"Skipped a row older than the newest one in the ring buffer ({self.n_skipped} so far)")
+            return
+        slot = count % self.capacity
+        header[_H_SEQ] += 1
+        self.times[slot] = time_ms
+        self.data[:, slot] = [np.nan if value is None else value for value in row]
+        header[_H_COUNT] = count + 1
+        header[_H_SEQ] += 1
+
+    def views(self):
+        """
+        Returns (count, times, data): the raw arrays of the ring, without copying.
+        The rows are in slots count % capacity order, and the writer may change them at any time.
+        """
+        return (self.count, self.times, self.data)
+
+    def read(self, seconds=None, n=None, cols=None, retries=10):
+        """
+        Returns a consistent copy (times, values) of the most recent rows, in time order:
+        times is int64 epoch milliseconds, values a float64 array with one row per col.
+        Either the last n rows, or the rows of the last given seconds (relative to the newest row), or everything.
+        cols is a list of column names, by default all.
+        """
+        if cols is None:
+            rows = slice(None)
+        else:
+            rows = [self.index[col] for col in cols]
+
+        for attempt in range(retries):
+            seq = int(self.header[_H_SEQ])
+            if seq % 2 == 1: # Writer is busy
+                time.sleep(0.001)
+                continue
+            count = int(self.header[_H_COUNT])
+            available = min(count, self.capacity)
+            if n is not None:
+                available = min(available, n)
+            slots = (np.arange(count - available, count) % self.capacity)
+            times = self.times[slots]
+            values = self.data[rows][:, slots]
+            if int(self.header[_H_SEQ]) == seq:
+                break
+        else:
+            raise RuntimeError("Could not get a consistent read of the ring buffer")
+
+        if seconds is not None and len(times) > 0:
+            first = np.searchsorted(times, times[-1] - int(1000 * seconds), side="left")
+            times = times[first:]
+            values = values[:, first:]
+        return (times, values)
+
+    def close(self):
+        # The numpy arrays must be gone before the shared memory can be closed
+        del self.header, self.times, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()